@@ -1,141 +1,1635 @@
+import bisect
+import functools
+import json
+import logging
+import os
+import numpy as np
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
 import polars as pl
 import streamlit as st
 from plotly import graph_objs as go
 import altair as alt
-from vega_datasets import data as countries_data
 
-# Configurazione della pagina web
-st.set_page_config(
-    layout = "wide",
-    initial_sidebar_state = "collapsed",
-    page_title = "Lake temperatures"
-)
+# I grafici serializzati con to_json() non hanno limiti sul numero di righe,
+# come quelli visualizzati con st.altair_chart
+alt.data_transformers.disable_max_rows()
 
-# Funzione che carica i dataset
-def load_data():
+# Strumentazione delle funzioni principali, attivata con la variabile d'ambiente
+# LAKE_TEMPERATURES_DEBUG=1. Per ogni rerun vengono registrati il tempo, le righe in
+# ingresso ed in uscita ed i byte dei grafici inviati al browser
+DEBUG = os.environ.get("LAKE_TEMPERATURES_DEBUG", "") not in ("", "0")
+
+# Logger delle righe JSON della strumentazione
+logger = logging.getLogger("lake_temperatures")
+if DEBUG and not logger.handlers:
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# Funzioni che leggono le righe di uno o più laghi: le loro righe in uscita vengono
+# registrate come righe in ingresso della funzione strumentata che le chiama
+ROW_READERS = {"lake_rows", "lakes_rows"}
+
+# Chiamate strumentate in corso nel thread della sessione, dalla più esterna alla più interna
+debug_stack = threading.local()
+
+# Funzione che ritorna il numero di righe di un dataframe, di un grafico Altair
+# (senza serializzarlo) o di una collezione di questi
+def count_rows(value):
+    
+    if isinstance(value, pl.DataFrame):
+        return value.height
+    if isinstance(value, alt.TopLevelMixin):
+        parts = [getattr(value, "data", None)] + list(getattr(value, "layer", None) or [])
+        parts += [getattr(value, "spec", None)] if isinstance(getattr(value, "spec", None), alt.TopLevelMixin) else []
+        return count_rows([part for part in parts if isinstance(part, (pl.DataFrame, alt.TopLevelMixin))])
+    if isinstance(value, (list, tuple)):
+        rows = [count_rows(item) for item in value]
+        rows = [r for r in rows if r is not None]
+        return sum(rows) if rows else None
+    
+    return None
+
+# Funzione che controlla che uno spec Vega-Lite contenga ogni insieme di righe una sola volta:
+# ritorna i dataset con righe identiche ad un altro dataset ed i dati inseriti direttamente
+# nei layer invece che registrati come dataset con nome
+def duplicate_datasets(spec):
+    
+    duplicates = []
+    seen = {}
+    
+    for name, rows in spec.get("datasets", {}).items():
+        key = json.dumps(rows, sort_keys = True)
+        if key in seen:
+            duplicates.append(name + " = " + seen[key])
+        seen.setdefault(key, name)
+    
+    def inline(node, path):
+        if isinstance(node, dict):
+            if isinstance(node.get("data"), dict) and "values" in node["data"]:
+                duplicates.append(path + "/data")
+            for key, child in node.items():
+                if key != "datasets":
+                    inline(child, path + "/" + key)
+        elif isinstance(node, list):
+            for i, child in enumerate(node):
+                inline(child, path + "/" + str(i))
+    
+    inline(spec, "")
+    
+    return duplicates
+
+# Funzione che ritorna le righe dei dataset ed il numero di dataset duplicati di uno spec
+# Vega-Lite già deserializzato, o di una lista di spec
+def spec_payload(spec):
     
-    # Dataset con i valori
-    values = pl.read_csv(
+    specs = spec if isinstance(spec, list) else [spec]
     
-        source = "values.csv"
+    return (
+        sum(len(rows) for item in specs for rows in item.get("datasets", {}).values()),
+        sum(len(duplicate_datasets(item)) for item in specs)
+    )
+
+# Funzione che aggiunge dei campi alla misurazione della chiamata strumentata in corso,
+# ad esempio i byte di uno spec già serializzato
+def debug_record(**fields):
+    
+    stack = getattr(debug_stack, "calls", None)
+    if DEBUG and stack:
+        stack[-1].update(fields)
+
+# Decoratore che registra la durata e le righe di ogni chiamata della funzione. Le righe in
+# ingresso sono quelle lette per il lago dalle ROW_READERS chiamate, o altrimenti quelle degli
+# argomenti; i byte degli spec vengono registrati da cached_spec. Senza DEBUG la funzione rimane invariata
+def instrument(function):
+    
+    if not DEBUG:
+        return function
+    
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
         
-        # Rimuovo le osservazioni superflue
-        ).filter(
-        pl.col("recordID") != 228540
+        stack = debug_stack.__dict__.setdefault("calls", [])
+        fields = {}
+        stack.append(fields)
         
-        # Rimuovo le colonne superflue
-        ).select(
-            pl.col("*").exclude("recordID")
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            stack.pop()
+        seconds = time.perf_counter() - start
         
-        )
+        rows_out = fields.get("rows_out", count_rows(result))
+        
+        # Le ROW_READERS leggono tramite l'indice solo le righe del lago, che
+        # vengono registrate anche come righe lette dalla funzione chiamante
+        if function.__name__ in ROW_READERS:
+            fields["rows_in"] = rows_out
+            if stack:
+                stack[-1]["rows_in"] = stack[-1].get("rows_in", 0) + (rows_out or 0)
+        
+        st.session_state.setdefault("debug_calls", []).append({
+            "function": function.__name__,
+            # Argomenti semplici, come il siteID o il tipo di grafico
+            "args": " ".join(str(arg) for arg in args if isinstance(arg, (int, str))),
+            "ms": round(seconds * 1000, 3),
+            "rows_in": fields.get("rows_in", count_rows(args)),
+            "rows_out": rows_out,
+            "bytes": fields.get("bytes"),
+            "duplicates": fields.get("duplicates")
+        })
+        
+        return result
     
-    # Dataset con le informazioni per lago
-    lakeinformation = pl.read_csv(
+    return wrapper
+
+# Funzione che chiude le misurazioni di una sezione dell'app: scrive una riga JSON nel log
+# e la conserva per il pannello di debug
+def debug_flush(section):
+    
+    if not DEBUG:
+        return
+    
+    calls = st.session_state.pop("debug_calls", [])
+    run = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "section": section,
+        "total_ms": round(sum(call["ms"] for call in calls), 3),
+        "calls": calls
+    }
     
-        source = "lakeinformation.csv",
-        encoding = "utf8-lossy"
-        
-        # Rimuovo le colonne superflue
-        ).select(
-            pl.col("*").exclude("contributor", "Other_names", "geospatial_accuracy_km")
+    logger.info(json.dumps(run))
+    
+    # Vengono conservati solo gli ultimi rerun
+    runs = st.session_state.setdefault("debug_runs", [])
+    runs.append(run)
+    del runs[:-20]
+
+# Pannello di debug nella sidebar. È un fragment aggiornato periodicamente, in modo da
+# mostrare anche i rerun delle altre sezioni
+@st.fragment(run_every = 2)
+def debug_panel():
+    
+    st.markdown("## Debug")
+    st.json(cache_info(), expanded = False)
+    
+    for run in reversed(st.session_state.get("debug_runs", [])[-5:]):
+        with st.expander(run["section"] + " · " + str(run["total_ms"]) + " ms · " + run["time"][11:19]):
+            if run["calls"]:
+                st.dataframe(pl.DataFrame(run["calls"]), hide_index = True)
+
+# Laghi di lakeinformation.csv che sono copie satellitari di laghi già presenti
+DUPLICATE_SITES = range(342, 350)
+
+# Tabelle di traduzione in italiano delle colonne categoriche. I valori tradotti
+# definiscono le categorie (pl.Enum) delle rispettive colonne
+REGIONS = {
+    "Africa": "Africa",
+    "Asia": "Asia",
+    "Europe": "Europa",
+    "Middle East": "Medio Oriente",
+    "Northeastern North America": "Nord America nord-orientale",
+    "Oceania": "Oceania",
+    "South America": "Sud America",
+    "Southeastern North America": "Nord America sud-orientale",
+    "Western North America": "Nord America occidentale"
+}
+LAKE_TYPES = {"Lake": "Naturale", "Reservoir": "Artificiale"}
+SOURCES = {"in situ": "in situ", "satellite": "satellite"}
+TIME_PERIODS = {
+    "JAS": "Luglio-Agosto-Settembre",
+    "JFM": "Gennaio-Febbraio-Marzo",
+    "JJA": "Giugno-Luglio-Agosto"
+}
+
+# Etichette delle variabili mostrate nelle legende dei grafici
+SEASONS = {
+    "Air_Temp_Mean_Annual_CRU": "Annuale",
+    "Air_Temp_Mean_Summer_CRU": "Estiva",
+    "Air_Temp_Mean_Winter_CRU": "Invernale",
+    "Radiation_Total_Annual": "Annuale",
+    "Radiation_Total_Summer": "Estiva",
+    "Radiation_Total_Winter": "Invernale"
+}
+
+# Funzione che traduce una colonna categorica con la relativa tabella
+def translate(column, table):
+    return pl.col(column).replace_strict(table, return_dtype = pl.Enum(sorted(set(table.values()))))
+
+# Memoria massima (in byte) occupata dai grafici serializzati nella cache, configurabile
+# in MiB con la variabile d'ambiente LAKE_TEMPERATURES_CHART_CACHE_MB (di default 64 MiB)
+CHART_CACHE_BYTES = int(float(os.environ.get("LAKE_TEMPERATURES_CHART_CACHE_MB", "64")) * 1024 * 1024)
+
+# Versione del formato del dataset compilato: se cambia (ad esempio per nuove regole
+# o colonne) il dataset viene ricompilato
+DATASET_VERSION = 2
+
+# Colonne geomorfometriche numeriche di lakeinformation.csv
+MEASURES = ["elevation_m", "mean_depth_m", "max_depth_m", "surface_area_km2", "volume_km3"]
+
+# Intervalli ammessi dei valori per prefisso della variabile, nelle unità del dataset:
+# gradi centigradi, frazione di copertura nuvolosa e watt per metro quadrato
+VALUE_RANGES = {
+    "Lake_Temp": (-5, 45),
+    "Air_Temp": (-70, 60),
+    "Cloud_Cover": (0, 1),
+    "Radiation": (0, 1500)
+}
+
+# Valore oltre il quale la copertura nuvolosa è considerata in percentuale: tra 1 e questo
+# valore una frazione appena fuori intervallo verrebbe confusa con una percentuale molto bassa
+CLOUD_PERCENT_MIN = 1.5
+
+# Funzione che ritorna la condizione dei valori fuori dagli intervalli ammessi
+def out_of_range(ranges):
+    return pl.any_horizontal(
+        pl.col("variable").str.starts_with(prefix) & ~pl.col("value").is_between(low, high)
+        for prefix, (low, high) in ranges.items()
+    )
+
+# Regole di validazione di values.csv, applicate in ordine una sola volta da compile_dataset
+# e ad ogni aggiunta. "when" individua le righe coinvolte (può dipendere dai siteID validi),
+# "drop" le scarta e "fix" sostituisce le colonne indicate
+VALUE_RULES = [
+    {
+        "name": "valori_nulli",
+        "description": "Misurazioni senza lago, variabile, anno o valore, o con valori non numerici",
+        "when": pl.any_horizontal(pl.col("siteID", "variable", "year", "value").is_null()),
+        "action": "drop"
+    },
+    {
+        "name": "kelvin",
+        "description": "Temperature in kelvin convertite in gradi centigradi",
+        "when": pl.col("variable").str.contains("_Temp_") & (pl.col("value") > 150),
+        "action": "fix",
+        "fix": {"value": pl.col("value") - 273.15}
+    },
+    {
+        "name": "copertura_percentuale",
+        "description": "Copertura nuvolosa in percentuale convertita in frazione: solo i valori chiaramente "
+                       "in percentuale, gli altri valori sopra 1 vengono scartati come fuori intervallo",
+        "when": pl.col("variable").str.starts_with("Cloud_Cover") & pl.col("value").is_between(CLOUD_PERCENT_MIN, 100, closed = "right"),
+        "action": "fix",
+        "fix": {"value": pl.col("value") / 100}
+    },
+    {
+        "name": "fuori_intervallo",
+        "description": "Valori fuori dall'intervallo ammesso per la variabile",
+        "when": out_of_range(VALUE_RANGES),
+        "action": "drop"
+    },
+    {
+        "name": "laghi_sconosciuti",
+        "description": "Misurazioni di laghi assenti da lakeinformation.csv o scartati",
+        "when": lambda sites: ~pl.col("siteID").is_in(sites),
+        "action": "drop"
+    },
+    {
+        "name": "duplicati",
+        "description": "Più misurazioni dello stesso lago, variabile ed anno: viene tenuta la prima",
+        "when": ~pl.struct("siteID", "variable", "year").is_first_distinct(),
+        "action": "drop"
+    }
+]
+
+# Regole di validazione di lakeinformation.csv
+LAKE_RULES = [
+    {
+        "name": "copie_satellitari",
+        "description": "Laghi che sono copie satellitari di laghi già presenti",
+        "when": pl.col("siteID").is_in(DUPLICATE_SITES),
+        "action": "drop"
+    },
+    {
+        "name": "siteID_duplicati",
+        "description": "Laghi con siteID già presente: viene tenuto il primo",
+        "when": pl.col("siteID").is_null() | ~pl.col("siteID").is_first_distinct(),
+        "action": "drop"
+    },
+    {
+        "name": "coordinate",
+        "description": "Laghi con latitudine o longitudine mancanti o fuori intervallo",
+        "when": ~(pl.col("latitude").is_between(-90, 90) & pl.col("longitude").is_between(-180, 180)).fill_null(False),
+        "action": "drop"
+    },
+    {
+        "name": "nomi",
+        "description": "Punti nei nomi dei laghi sostituiti da spazi",
+        "when": pl.col("Lake_name").str.contains(".", literal = True),
+        "action": "fix",
+        "fix": {"Lake_name": pl.col("Lake_name").str.replace_all(".", " ", literal = True)}
+    },
+    {
+        "name": "tipo_di_lago",
+        "description": "Tipo di lago con maiuscole o spazi non uniformi",
+        "when": pl.col("lake_or_reservoir") != pl.col("lake_or_reservoir").str.strip_chars().str.to_titlecase(),
+        "action": "fix",
+        "fix": {"lake_or_reservoir": pl.col("lake_or_reservoir").str.strip_chars().str.to_titlecase()}
+    },
+    {
+        "name": "categorie_sconosciute",
+        "description": "Laghi con tipo, regione, metodo o periodo di campionamento sconosciuti",
+        "when": ~(
+            pl.col("lake_or_reservoir").is_in(list(LAKE_TYPES)) & pl.col("region").is_in(list(REGIONS))
+            & pl.col("source").is_in(list(SOURCES)) & pl.col("time_period").is_in(list(TIME_PERIODS))
+        ).fill_null(False),
+        "action": "drop"
+    },
+    {
+        "name": "profondità_di_campionamento",
+        "description": "Temperatura di pelle dei satelliti (skin-derived bulk temperature), "
+                       "approssimativamente equivalente ad 1 metro di profondità",
+        "when": pl.col("sampling_depth") == "skin-derived bulk temperature",
+        "action": "fix",
+        "fix": {"sampling_depth": pl.lit("1")}
+    },
+    {
+        "name": "profondità_non_numerica",
+        "description": "Profondità di campionamento non numerica, sostituita con un valore nullo",
+        "when": pl.col("sampling_depth").is_not_null() & pl.col("sampling_depth").cast(pl.Float64, strict = False).is_null(),
+        "action": "fix",
+        "fix": {"sampling_depth": pl.lit(None, dtype = pl.String)}
+    },
+    {
+        "name": "misure_negative",
+        "description": "Elevazione, profondità, superficie o volume negativi, sostituiti con un valore nullo",
+        "when": pl.any_horizontal(pl.col(column) < 0 for column in MEASURES if column != "elevation_m"),
+        "action": "fix",
+        "fix": {column: pl.when(pl.col(column) >= 0).then(pl.col(column)) for column in MEASURES if column != "elevation_m"}
+    }
+]
+
+# Funzione che applica in ordine le regole ad una tabella e ritorna la tabella validata
+# e, per ogni regola, il numero di righe coinvolte con alcuni dei relativi siteID
+def apply_rules(frame, rules, table, sites = None):
+    
+    report = []
+    
+    for rule in rules:
         
-        # Rimuovo le osservazioni superflue
-        ).filter(
-            pl.col("siteID") < 342
+        when = rule["when"](sites) if callable(rule["when"]) else rule["when"]
+        mask = frame.select(when.fill_null(False)).to_series()
         
-        # Aggiusto i nomi dei laghi
-        ).with_columns(
-            pl.col("Lake_name").str.replace_all(r"\.", " ")
+        report.append({
+            "table": table,
+            "rule": rule["name"],
+            "description": rule["description"],
+            "action": rule["action"],
+            "rows": mask.sum(),
+            "sites": frame.filter(mask).get_column("siteID").drop_nulls().unique(maintain_order = True).head(10).to_list()
+        })
         
-        # Formatto la colonna "lake_or_reservoir"
-        ).with_columns(
-            pl.col("lake_or_reservoir").str.replace("l", "L").str.strip_chars_end(" ").replace(
-                ["Lake", "Reservoir"], ["Naturale", "Artificiale"]
+        if rule["action"] == "drop":
+            frame = frame.filter(~mask)
+        else:
+            frame = frame.with_columns(
+                pl.when(mask).then(expression).otherwise(pl.col(column)).alias(column)
+                for column, expression in rule["fix"].items()
             )
+    
+    return frame, report
+
+# Funzione che legge un csv nel formato di values.csv con i tipi del dataset:
+# i valori non convertibili diventano nulli e vengono scartati dalle regole
+def read_values(source):
+    return pl.read_csv(source, infer_schema = False).select(
+        pl.col("siteID").cast(pl.Int64, strict = False),
+        pl.col("variable"),
+        pl.col("year").cast(pl.Int64, strict = False),
+        pl.col("value").cast(pl.Float64, strict = False)
+    )
+
+# Funzione che converte i valori validati nel formato compilato: variabile come pl.Enum,
+# etichetta della stagione ed ordinamento per siteID, variable e year
+def type_values(values, variables):
+    return with_season(
+        values.select(
+            pl.col("variable").cast(pl.Enum(variables)),
+            "year",
+            "siteID",
+            "value"
+        ).sort(
+            "siteID", "variable", "year"
+        )
+    )
+
+# Funzione che converte le informazioni dei laghi validate nel formato compilato: colonne
+# categoriche tradotte in italiano come pl.Enum e misure numeriche con valori nulli tipizzati
+def type_lakeinformation(lakes):
+    return lakes.select(
+        "siteID",
+        "Lake_name",
+        "Other_names",
+        translate("lake_or_reservoir", LAKE_TYPES),
+        "location",
+        translate("region", REGIONS),
+        pl.col("latitude", "longitude").cast(pl.Float64),
+        pl.col(MEASURES).cast(pl.Float64, strict = False),
+        translate("source", SOURCES),
+        pl.col("sampling_depth").cast(pl.Float64),
+        pl.col("sampling_time_of_day").replace("continuous", "Continuo"),
+        translate("time_period", TIME_PERIODS)
+    )
+
+# Funzione che ritorna la cartella del dataset compilato, accanto a values.csv
+def dataset_folder(values_source = "values.csv"):
+    return os.path.splitext(values_source)[0] + "_compiled"
+
+# Funzione che scrive un dataframe come file Arrow non compresso, che può essere mappato
+# in memoria. Il file viene rinominato solo a scrittura completata: i processi che mappano
+# ancora il file precedente continuano a leggerlo senza errori
+def write_arrow(frame, path):
+    frame.write_ipc(path + ".tmp", compression = "uncompressed")
+    os.replace(path + ".tmp", path)
+
+# Funzione che valida values.csv e lakeinformation.csv con le regole e scrive il dataset
+# compilato: i due file Arrow ed il rapporto di qualità report.json, scritto per ultimo
+def compile_dataset(values_source = "values.csv", lakeinformation_source = "lakeinformation.csv", folder = None):
+    
+    if folder is None:
+        folder = dataset_folder(values_source)
+    
+    raw_lakes = pl.read_csv(lakeinformation_source, encoding = "utf8-lossy")
+    lakes, lake_report = apply_rules(raw_lakes, LAKE_RULES, "lakeinformation")
+    lakeinformation = type_lakeinformation(lakes)
+    
+    raw_values = read_values(values_source)
+    values, value_report = apply_rules(raw_values, VALUE_RULES, "values", lakeinformation.get_column("siteID"))
+    values = type_values(values, sorted(values.get_column("variable").unique()))
+    
+    os.makedirs(folder, exist_ok = True)
+    write_arrow(values, os.path.join(folder, "values.arrow"))
+    write_arrow(lakeinformation, os.path.join(folder, "lakeinformation.arrow"))
+    
+    report = {
+        "version": DATASET_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "sources": {"values": os.path.abspath(values_source), "lakeinformation": os.path.abspath(lakeinformation_source)},
+        "tables": {
+            name: {
+                "rows_in": raw.height,
+                "rows_out": frame.height,
+                "schema": {column: str(dtype) for column, dtype in frame.schema.items()},
+                "nulls": {column: count for column, count in frame.null_count().row(0, named = True).items() if count}
+            }
+            for name, raw, frame in [("values", raw_values, values), ("lakeinformation", raw_lakes, lakeinformation)]
+        },
+        "rules": lake_report + value_report
+    }
+    
+    with open(os.path.join(folder, "report.json") + ".tmp", "w", encoding = "utf8") as f:
+        json.dump(report, f, indent = 2, ensure_ascii = False)
+    os.replace(os.path.join(folder, "report.json") + ".tmp", os.path.join(folder, "report.json"))
+    
+    return report
+
+# Funzione che ritorna la cartella del dataset compilato, compilandolo solo se manca,
+# se i csv sono più recenti o se è stato compilato con un formato precedente
+def build_dataset(values_source = "values.csv", lakeinformation_source = "lakeinformation.csv"):
+    
+    folder = dataset_folder(values_source)
+    report_path = os.path.join(folder, "report.json")
+    
+    if os.path.exists(report_path) and os.path.getmtime(report_path) >= max(
+        os.path.getmtime(values_source), os.path.getmtime(lakeinformation_source)
+    ):
+        with open(report_path, encoding = "utf8") as f:
+            report = json.load(f)
+        if report["version"] == DATASET_VERSION and report["sources"] == {
+            "values": os.path.abspath(values_source), "lakeinformation": os.path.abspath(lakeinformation_source)
+        }:
+            return folder
+    
+    logger.warning("Dataset compilato mancante o non aggiornato: compilazione di %s e %s", values_source, lakeinformation_source)
+    compile_dataset(values_source, lakeinformation_source, folder)
+    
+    return folder
+
+# Funzione che ritorna la cartella con le aggiunte ai valori di values.csv
+def delta_folder(source = "values.csv"):
+    return os.path.splitext(source)[0] + "_delta"
+
+# Funzione che ritorna i file delle aggiunte in ordine di inserimento
+def delta_files(source = "values.csv"):
+    
+    folder = delta_folder(source)
+    if not os.path.isdir(folder):
+        return []
+    
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.endswith(".arrow")]
+
+# Funzione che aggiunge ai valori le righe di un csv con lo stesso formato di values.csv,
+# ad esempio una nuova stagione di dati. Le righe vengono validate con le stesse regole
+# della compilazione e salvate come un nuovo file Arrow nella cartella delle aggiunte,
+# senza ricompilare values.csv. Ritorna il file creato, il numero di righe aggiunte ed
+# il rapporto delle regole
+def append_values(rows_source, values_source = "values.csv", lakeinformation_source = "lakeinformation.csv"):
+    
+    folder = build_dataset(values_source, lakeinformation_source)
+    schema = pl.scan_ipc(os.path.join(folder, "values.arrow")).collect_schema()
+    sites = pl.read_ipc(os.path.join(folder, "lakeinformation.arrow"), columns = ["siteID"]).get_column("siteID")
+    
+    rows, report = apply_rules(read_values(rows_source), VALUE_RULES, "values", sites)
+    
+    # Le variabili devono essere tra quelle del pl.Enum del dataset compilato
+    unknown = set(rows.get_column("variable").unique()) - set(schema["variable"].categories)
+    if unknown:
+        raise ValueError(f"Variabili non presenti in {values_source}: {', '.join(sorted(unknown))}")
+    
+    rows = type_values(rows, schema["variable"].categories)
+    
+    # Il nome del file segue l'ordine di inserimento
+    os.makedirs(delta_folder(values_source), exist_ok = True)
+    path = os.path.join(delta_folder(values_source), datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f") + ".arrow")
+    write_arrow(rows, path)
+    
+    return path, rows.height, report
+
+# Funzione che aggiunge ai valori l'etichetta della stagione mostrata nelle legende
+def with_season(values):
+    return values.with_columns(
+        pl.col("variable").cast(pl.String).replace_strict(
+            SEASONS, default = None, return_dtype = pl.Enum(sorted(set(SEASONS.values())))
+        ).alias("season")
+    )
+
+# Funzione che legge in modo lazy i valori compilati e le aggiunte indicate: se una coppia
+# (siteID, variable) ha più valori per lo stesso anno viene tenuto l'ultimo aggiunto
+def scan_values(folder, deltas):
+    
+    store = pl.scan_ipc(os.path.join(folder, "values.arrow"), memory_map = True)
+    
+    if not deltas:
+        return store
+    
+    return pl.concat(
+        [store] + [pl.scan_ipc(delta, memory_map = True) for delta in deltas]
+    ).unique(
+        ["siteID", "variable", "year"], keep = "last", maintain_order = True
+    ).sort(
+        "siteID", "variable", "year"
+    )
+
+# Funzione che carica i dataset compilati: i file Arrow sono già validati, tipizzati ed
+# ordinati e vengono mappati in memoria, senza pulizie ad ogni caricamento
+@instrument
+def load_data(values_source = "values.csv", lakeinformation_source = "lakeinformation.csv", deltas = None):
+    
+    folder = build_dataset(values_source, lakeinformation_source)
+    
+    if deltas is None:
+        deltas = delta_files(values_source)
+    
+    # Dataset con i valori, letto in modo lazy
+    values = scan_values(folder, deltas)
+    
+    # Dataset con le informazioni per lago
+    lakeinformation = pl.read_ipc(os.path.join(folder, "lakeinformation.arrow"), memory_map = True)
+
+    return values, lakeinformation
+
+# Funzione che costruisce l'indice dei valori: per ogni coppia (siteID, variable)
+# riporta la posizione della prima riga ed il numero di righe. Il dataset deve essere
+# ordinato per siteID, variable e year, come il dataset compilato: l'inizio di ogni coppia
+# è la riga in cui cambia il siteID o la variabile rispetto alla precedente
+def build_index(values):
+    
+    sites = values.get_column("siteID").to_numpy()
+    variables = values.get_column("variable").to_physical().to_numpy()
+    names = values.get_column("variable").cat.get_categories().to_list()
+    
+    starts = np.flatnonzero(np.concatenate([[True], (sites[1:] != sites[:-1]) | (variables[1:] != variables[:-1])]))[:len(sites)]
+    lengths = np.diff(np.append(starts, len(sites)))
+    
+    return dict(zip(
+        zip(sites[starts].tolist(), [names[variable] for variable in variables[starts].tolist()]),
+        zip(starts.tolist(), lengths.tolist())
+    ))
+
+# Funzione che ritorna le righe di un lago per le variabili richieste.
+# Le righe vengono ricavate dall'indice come slice, senza scorrere tutto il dataset
+@instrument
+def lake_rows(data, index, lakeID, variables):
+    
+    slices = [data.slice(*index[(lakeID, variable)]) for variable in variables if (lakeID, variable) in index]
+    
+    if not slices:
+        return data.clear()
+    
+    return pl.concat(slices, rechunk = False)
+
+# Funzione che ritorna le righe di più laghi per le variabili richieste con un'unica lettura:
+# le posizioni di tutte le slice dell'indice vengono unite e le righe estratte insieme
+@instrument
+def lakes_rows(data, index, lakeIDs, variables):
+    
+    ranges = [index[(lakeID, variable)] for lakeID in lakeIDs for variable in variables if (lakeID, variable) in index]
+    
+    if not ranges:
+        return data.clear()
+    
+    return data[np.concatenate([np.arange(offset, offset + length) for offset, length in ranges])]
+
+# Funzione che costruisce la rappresentazione densa dei valori: un cubo float32
+# lago × variabile × anno con la relativa maschera dei valori presenti e le tabelle
+# che associano ad ogni siteID, variabile ed anno la sua posizione nel cubo.
+# Il cubo serve solo al calcolo di trend e fattori climatici e non viene conservato:
+# grafici ed anni mancanti leggono le righe del lago dalla tabella tramite l'indice,
+# che resta comunque necessaria, ed un cubo in più aumenterebbe la memoria occupata
+def build_cube(values):
+    
+    sites = values.get_column("siteID").unique().sort()
+    variables = values.get_column("variable").unique().sort().cast(pl.String)
+    years = data_years(values)
+    
+    # Posizione nel cubo di ciascuna riga
+    s = np.searchsorted(sites.to_numpy(), values.get_column("siteID").to_numpy())
+    v = values.get_column("variable").cast(pl.String).cast(pl.Enum(variables)).to_physical().to_numpy()
+    y = values.get_column("year").to_numpy() - years.start
+    
+    cube = np.full((len(sites), len(variables), len(years)), np.nan, dtype = np.float32)
+    mask = np.zeros(cube.shape, dtype = bool)
+    
+    cube[s, v, y] = values.get_column("value").to_numpy()
+    mask[s, v, y] = values.get_column("value").is_not_null().to_numpy()
+    
+    return {
+        "values": cube,
+        "mask": mask,
+        "sites": {site: i for i, site in enumerate(sites)},
+        "variables": {variable: i for i, variable in enumerate(variables)},
+        "years": {year: i for i, year in enumerate(years)}
+    }
+
+# Prefissi delle variabili su cui vengono calcolati i trend di riscaldamento
+TREND_PREFIXES = ("Lake_Temp", "Air_Temp")
+
+# Numero massimo di valori tenuti in memoria insieme dallo stimatore di Theil–Sen: limita sia
+# il blocco di laghi elaborato (laghi × anni) sia le pendenze raccolte per calcolare la mediana
+TREND_CHUNK = 2 ** 23
+
+# Numero di classi dell'istogramma con cui viene ristretto l'intervallo che contiene la mediana
+TREND_BINS = 1024
+
+# Funzione che ritorna il p-value bilaterale della t di Student con df gradi di libertà interi,
+# calcolato con le serie finite di Abramowitz e Stegun (26.7.3 e 26.7.4) su tutti gli elementi
+def t_pvalue(t, df):
+    
+    theta = np.arctan(np.abs(t) / np.sqrt(df))
+    sin, cos = np.sin(theta), np.cos(theta)
+    odd = df % 2 == 1
+    
+    # Somma dei termini della serie: per df pari fino a cos^(df-2), per df dispari fino a cos^(df-3)
+    term = np.ones_like(theta)
+    total = np.ones_like(theta)
+    last = np.where(odd, (df - 3) // 2, (df - 2) // 2)
+    
+    for k in range(1, int(last.max(initial = 0)) + 1):
+        term = term * cos ** 2 * np.where(odd, 2 * k / (2 * k + 1), (2 * k - 1) / (2 * k))
+        total = total + np.where(k <= last, term, 0)
+    
+    probability = np.where(
+        odd,
+        2 / np.pi * (theta + np.where(df > 1, sin * cos * total, 0)),
+        sin * total
+    )
+    
+    return np.clip(1 - probability, 0, 1)
+
+# Funzione che ritorna, per ogni distanza k tra gli anni, le pendenze delle coppie (i, i + k)
+# di ogni riga, con NaN dove manca uno dei due anni
+def gap_slopes(y, mask, years):
+    
+    for k in range(1, len(years)):
+        yield np.where(
+            mask[:, k:] & mask[:, :-k],
+            (y[:, k:] - y[:, :-k]) / (years[k:] - years[:-k]),
+            np.nan
+        )
+
+# Funzione che ritorna per ogni riga la pendenza a coppie di rango rank senza tenerle tutte in memoria:
+# finché le pendenze nell'intervallo [lo, hi] che contiene quel rango sono troppe, l'intervallo viene
+# ristretto alla classe di un istogramma che lo contiene; poi le pendenze rimaste vengono raccolte ed ordinate
+def select_slopes(y, mask, years, rank):
+    
+    n = mask.sum(axis = 1).astype(np.int64)
+    count = n * (n - 1) // 2
+    selected = np.full(len(y), np.nan)
+    pending = np.flatnonzero((rank >= 0) & (rank < count))
+    lo = np.full(len(y), -np.inf)
+    hi = np.full(len(y), np.inf)
+    below = np.zeros(len(y), dtype = np.int64)
+    
+    while len(pending):
+        
+        # Righe con tutte le pendenze dell'intervallo uguali
+        equal = lo[pending] == hi[pending]
+        selected[pending[equal]] = lo[pending[equal]]
+        pending = pending[~equal]
+        
+        rows_lo, rows_hi = lo[pending, None], hi[pending, None]
+        target = rank[pending] - below[pending]
+        slopes = lambda: gap_slopes(y[pending], mask[pending], years)
         
-        # Traduco in italiano la colonna "region"
-        ).with_columns(
+        if len(pending) * count[pending].max(initial = 0) <= TREND_CHUNK:
             
-            pl.col("region").replace([
-                "Europe", "Middle East", "Northeastern North America", "South America", "Southeastern North America", "Western North America"
-            ], [
-                "Europa", "Medio Oriente", "Nord America nord-orientale", "Sud America", "Nord America sud-orientale", "Nord America occidentale"
-            ])
+            # Raccolta delle pendenze dell'intervallo in una matrice riga × pendenza, ordinata per riga
+            collected = np.full((len(pending), count[pending].max(initial = 0)), np.inf)
+            filled = np.zeros(len(pending), dtype = np.int64)
+            for block in slopes():
+                inside = (block >= rows_lo) & (block <= rows_hi)
+                position = filled[:, None] + inside.cumsum(axis = 1) - 1
+                row, column = np.nonzero(inside)
+                collected[row, position[row, column]] = block[row, column]
+                filled += inside.sum(axis = 1)
+            collected.sort(axis = 1)
             
-        # Formatto la colonna "sampling_depth" dove skin-derived bulk temperature è approssimativamente
-        # equivalente ad 1 metro di profondità
-        ).with_columns(
-            pl.col("sampling_depth").str.replace("skin-derived bulk temperature", "1")
-        
-        # Formatto le colonne "mean_depth_m", "max_depth_m", "volume_km3", "sampling_time_of_day"
-        ).with_columns(
-            pl.col("mean_depth_m").fill_null("Dato non presente"),
-            pl.col("max_depth_m").fill_null("Dato non presente"),
-            pl.col("volume_km3").fill_null("Dato non presente"),
-            pl.col("sampling_time_of_day").fill_null("Dato non presente").replace("continuous", "Continuo")
-        
-        # Formatto la colonna "time_period"
-        ).with_columns(
-            pl.col("time_period").replace(
-                ["JAS", "JFM", "JJA"],
-                ["Luglio-Agosto-Settembre", "Gennaio-Febbraio-Marzo", "Giugno-Luglio-Agosto"]
-            )
+            selected[pending] = collected[np.arange(len(pending)), target]
+            break
+        
+        if np.isinf(lo[pending]).any():
+            
+            # Primo restringimento: dal minimo al massimo delle pendenze presenti
+            lo[pending], hi[pending] = np.inf, -np.inf
+            for block in slopes():
+                lo[pending] = np.minimum(lo[pending], np.fmin.reduce(block, axis = 1, initial = np.inf))
+                hi[pending] = np.maximum(hi[pending], np.fmax.reduce(block, axis = 1, initial = -np.inf))
+            continue
+        
+        # Istogramma delle pendenze dell'intervallo e classe che contiene il rango cercato
+        width = (hi[pending] - lo[pending]) / TREND_BINS
+        offset = np.arange(len(pending))[:, None] * TREND_BINS
+        bin_of = lambda block: np.clip(((block - rows_lo) / width[:, None]).astype(np.int64), 0, TREND_BINS - 1)
+        
+        histogram = np.zeros(len(pending) * TREND_BINS, dtype = np.int64)
+        for block in slopes():
+            inside = (block >= rows_lo) & (block <= rows_hi)
+            histogram += np.bincount((bin_of(np.where(inside, block, rows_lo)) + offset)[inside], minlength = len(histogram))
+        histogram = histogram.reshape(len(pending), TREND_BINS)
+        cumulative = histogram.cumsum(axis = 1)
+        chosen_bin = (cumulative <= target[:, None]).sum(axis = 1)
+        
+        # Nuovo intervallo: minimo e massimo delle pendenze nella classe scelta
+        new_lo, new_hi = np.full(len(pending), np.inf), np.full(len(pending), -np.inf)
+        for block in slopes():
+            inside = (block >= rows_lo) & (block <= rows_hi)
+            chosen = inside & (bin_of(np.where(inside, block, rows_lo)) == chosen_bin[:, None])
+            new_lo = np.minimum(new_lo, np.where(chosen, block, np.inf).min(axis = 1))
+            new_hi = np.maximum(new_hi, np.where(chosen, block, -np.inf).max(axis = 1))
+        
+        rows = np.arange(len(pending))
+        below[pending] += cumulative[rows, chosen_bin] - histogram[rows, chosen_bin]
+        count[pending] = histogram[rows, chosen_bin]
+        lo[pending], hi[pending] = new_lo, new_hi
+    
+    return selected
+
+# Funzione che ritorna per ogni riga la mediana delle pendenze a coppie, media dei due ranghi centrali
+def theil_sen_median(y, mask, years):
+    
+    n = mask.sum(axis = 1).astype(np.int64)
+    pairs = n * (n - 1) // 2
+    
+    low = select_slopes(y, mask, years, (pairs - 1) // 2)
+    high = np.where(pairs % 2 == 1, low, select_slopes(y, mask, years, np.where(pairs % 2 == 0, pairs // 2, -1)))
+    
+    return (low + high) / 2
+
+# Funzione che calcola i trend di riscaldamento di tutti i laghi in un unico passaggio sul cubo:
+# per ogni lago e variabile di temperatura ritorna la pendenza OLS e quella di Theil–Sen
+# (in gradi per anno), il p-value della pendenza OLS ed il numero di anni con dati
+@instrument
+def build_trends(cube):
+    
+    variables = [variable for variable in cube["variables"] if variable.startswith(TREND_PREFIXES)]
+    rows = [cube["variables"][variable] for variable in variables]
+    sites = np.array(list(cube["sites"]))
+    years = np.array(list(cube["years"]), dtype = np.float64)
+    
+    # Matrice (lago, variabile) × anno
+    y = cube["values"][:, rows].astype(np.float64).reshape(-1, len(years))
+    mask = cube["mask"][:, rows].reshape(-1, len(years))
+    n = mask.sum(axis = 1)
+    
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        
+        # Regressione OLS con gli scarti dalla media dei soli anni presenti
+        x_mean = (mask * years).sum(axis = 1) / n
+        y_mean = np.where(mask, y, 0).sum(axis = 1) / n
+        dx = np.where(mask, years - x_mean[:, None], 0)
+        dy = np.where(mask, y - y_mean[:, None], 0)
+        
+        sxx = (dx ** 2).sum(axis = 1)
+        ols = (dx * dy).sum(axis = 1) / sxx
+        sse = ((dy - ols[:, None] * dx) ** 2).sum(axis = 1)
+        t = ols / np.sqrt(sse / (n - 2) / sxx)
+    
+    valid = n >= 3
+    p_value = np.full(len(n), np.nan)
+    p_value[valid] = t_pvalue(t[valid], n[valid] - 2)
+    
+    # Theil–Sen: mediana delle pendenze tra tutte le coppie di anni presenti,
+    # a blocchi di laghi in modo che ogni blocco abbia al massimo TREND_CHUNK valori
+    theil_sen = np.full(len(n), np.nan)
+    chunk = max(1, TREND_CHUNK // len(years))
+    
+    for start in range(0, len(n), chunk):
+        theil_sen[start:start + chunk] = theil_sen_median(y[start:start + chunk], mask[start:start + chunk], years)
+    
+    ols[n < 2] = np.nan
+    
+    return pl.DataFrame({
+        "siteID": np.repeat(sites, len(variables)),
+        "variable": np.tile(variables, len(sites)),
+        "n_years": n,
+        "ols_slope": ols,
+        "theil_sen_slope": theil_sen,
+        "p_value": p_value
+    }).with_columns(
+        pl.col("variable").cast(pl.Enum(variables)),
+        pl.col("n_years").cast(pl.UInt32),
+        pl.col("ols_slope", "theil_sen_slope", "p_value").fill_nan(None)
+    )
+
+# Funzione che ritorna per ogni lago il trend della temperatura dell'acqua,
+# qualunque sia il metodo di campionamento
+def lake_temperature_trends(trends):
+    return trends.filter(
+        pl.col("variable").cast(pl.String).str.starts_with("Lake_Temp") & (pl.col("n_years") > 0)
+    ).sort("n_years", descending = True).unique("siteID", keep = "first")
+
+# Funzione che ritorna i trend di un lago, indicizzati per variabile
+def lake_trends(trends, lakeID):
+    return {row["variable"]: row for row in trends.filter(pl.col("siteID") == lakeID).iter_rows(named = True)}
+
+# Funzione che descrive un trend in gradi per decennio
+def format_trend(trend):
+    
+    if trend is None or trend["theil_sen_slope"] is None:
+        return "Dati insufficienti"
+    
+    text = f"{trend['theil_sen_slope'] * 10:+.2f} °C/decennio"
+    if trend["p_value"] is not None:
+        text += f" (p = {trend['p_value']:.3f}, {trend['n_years']} anni)"
+    
+    return text
+
+# Fattori climatici estivi confrontati con la temperatura estiva dell'acqua e relative etichette
+DRIVERS = {
+    "Air_Temp_Mean_Summer_CRU": "Temperatura dell'aria",
+    "Cloud_Cover_Summer": "Copertura nuvolosa",
+    "Radiation_Total_Summer": "Radiazione solare"
+}
+
+# Funzione che calcola per tutti i laghi insieme la relazione tra la temperatura estiva
+# dell'acqua ed i fattori climatici: la correlazione con ciascun fattore (sugli anni in cui
+# sono presenti entrambi) e la regressione multipla su tutti i fattori (sugli anni in cui
+# sono presenti tutti), con i coefficienti anche standardizzati per confrontare i fattori
+@instrument
+def build_drivers(cube):
+    
+    sites = np.array(list(cube["sites"]))
+    drivers = [driver for driver in DRIVERS if driver in cube["variables"]]
+    
+    # Temperatura dell'acqua lago × anno: ogni lago ha un solo metodo di campionamento
+    lake = np.full(cube["values"].shape[::2], np.nan)
+    lake_mask = np.zeros(lake.shape, dtype = bool)
+    for variable in ["Lake_Temp_Summer_InSitu", "Lake_Temp_Summer_Satellite"]:
+        if variable in cube["variables"]:
+            rows = cube["values"][:, cube["variables"][variable]]
+            present = cube["mask"][:, cube["variables"][variable]] & ~lake_mask
+            lake[present] = rows[present]
+            lake_mask |= present
+    
+    # Fattori climatici lago × fattore × anno
+    rows = [cube["variables"][driver] for driver in drivers]
+    x = cube["values"][:, rows].astype(np.float64)
+    x_mask = cube["mask"][:, rows] & lake_mask[:, None]
+    y = np.broadcast_to(lake[:, None], x.shape)
+    
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        
+        # Correlazione di Pearson per ciascun fattore sugli anni presenti in entrambe le serie
+        n = x_mask.sum(axis = 2)
+        dx = np.where(x_mask, x - np.where(x_mask, x, 0).sum(axis = 2, keepdims = True) / n[..., None], 0)
+        dy = np.where(x_mask, y - np.where(x_mask, y, 0).sum(axis = 2, keepdims = True) / n[..., None], 0)
+        r = (dx * dy).sum(axis = 2) / np.sqrt((dx ** 2).sum(axis = 2) * (dy ** 2).sum(axis = 2))
+        r[n < 3] = np.nan
+        
+        # Regressione multipla sugli anni in cui sono presenti tutti i fattori: le equazioni
+        # normali di tutti i laghi vengono risolte insieme con la pseudo-inversa
+        joint = x_mask.all(axis = 1)
+        n_model = joint.sum(axis = 1)
+        design = np.concatenate([np.ones((len(sites), 1, x.shape[2])), x], axis = 1)
+        design = np.where(joint[:, None], design, 0).transpose(0, 2, 1)
+        target = np.where(joint, lake, 0)
+        
+        coefficients = np.einsum(
+            "skl,sl->sk",
+            np.linalg.pinv(np.einsum("stk,stl->skl", design, design)),
+            np.einsum("stk,st->sk", design, target)
         )
+        fitted = np.einsum("stk,sk->st", design, coefficients)
+        
+        y_mean = target.sum(axis = 1) / n_model
+        sst = np.where(joint, (target - y_mean[:, None]) ** 2, 0).sum(axis = 1)
+        r2 = 1 - np.where(joint, (target - fitted) ** 2, 0).sum(axis = 1) / sst
+        
+        # Coefficienti standardizzati con le deviazioni standard degli anni usati nel modello
+        x_mean = np.where(joint[:, None], x, 0).sum(axis = 2) / n_model[:, None]
+        x_std = np.sqrt(np.where(joint[:, None], (x - x_mean[..., None]) ** 2, 0).sum(axis = 2) / n_model[:, None])
+        beta = coefficients[:, 1:] * x_std / np.sqrt(sst / n_model)[:, None]
+    
+    # Il modello richiede almeno due anni in più rispetto ai parametri stimati
+    fit = n_model >= len(drivers) + 2
+    coefficients[~fit] = np.nan
+    beta[~fit] = np.nan
+    r2[~fit] = np.nan
+    
+    return pl.DataFrame({
+        "siteID": np.repeat(sites, len(drivers)),
+        "driver": np.tile(drivers, len(sites)),
+        "n_years": n.ravel(),
+        "r": r.ravel(),
+        "coefficient": coefficients[:, 1:].ravel(),
+        "beta": beta.ravel(),
+        "r2": np.repeat(r2, len(drivers)),
+        "n_model": np.repeat(n_model, len(drivers))
+    }).with_columns(
+        pl.col("driver").cast(pl.Enum(drivers)),
+        pl.col("n_years", "n_model").cast(pl.UInt32),
+        pl.col("r", "coefficient", "beta", "r2").fill_nan(None)
+    ).filter(
+        pl.col("n_years") > 0
+    )
 
-    return values, lakeinformation
+# Funzione che riassume per regione e fattore climatico la relazione con la temperatura dell'acqua
+def region_drivers(drivers, lakeinformation):
+    return drivers.join(
+        lakeinformation.select("siteID", "region"), on = "siteID"
+    ).group_by("region", "driver").agg(
+        pl.len().alias("lakes"),
+        pl.col("r").median().alias("r"),
+        (pl.col("r") > 0).mean().alias("positive"),
+        pl.col("beta").median().alias("beta"),
+        pl.col("r2").median().alias("r2")
+    ).sort("region", "driver")
+
+# Funzione che sostituisce in un dataframe ordinato per siteID le righe dei laghi indicati
+# con quelle di update, ordinato allo stesso modo. Le righe degli altri laghi vengono
+# riprese come slice, senza copiarle né riordinarle
+def splice_sites(frame, update, sites):
+    
+    sites = np.unique(np.asarray(sites))
+    column = frame.get_column("siteID").to_numpy()
+    update_column = update.get_column("siteID").to_numpy()
+    
+    parts = []
+    previous = 0
+    for start, stop, update_start, update_stop in zip(
+        np.searchsorted(column, sites, "left"), np.searchsorted(column, sites, "right"),
+        np.searchsorted(update_column, sites, "left"), np.searchsorted(update_column, sites, "right")
+    ):
+        parts.append(frame.slice(previous, start - previous))
+        parts.append(update.slice(update_start, update_stop - update_start))
+        previous = stop
+    parts.append(frame.slice(previous))
+    
+    return pl.concat(parts, rechunk = False)
 
-# Funzione che prende una riga di un dataframe e ritorna un dataframe
-# con valori 0.5 al posto dei valori mancanti
-def convert_null(df):
+# Funzione che unisce ai valori (ordinati come il dataset compilato) le righe aggiunte: i valori
+# già presenti per lo stesso (siteID, variable, year) vengono sostituiti. Vengono riordinate
+# solo le righe dei laghi coinvolti
+def merge_values(values, rows):
     
-    # Riorganizzazione del dataframe
-    df = df.pivot(on = "year", values = "value")
+    sites = rows.get_column("siteID").unique()
     
-    # Colonne che devono rimanere invariate
-    columns_to_keep = df.columns[:2]
+    affected = pl.concat([
+        values.filter(pl.col("siteID").is_in(sites)).join(
+            rows.select("siteID", "variable", "year"), on = ["siteID", "variable", "year"], how = "anti"
+        ),
+        rows.select(values.columns)
+    ]).sort("siteID", "variable", "year")
+    
+    return splice_sites(values, affected, sites)
+
+# Funzione che sostituisce in un dataframe per lago (trend o fattori climatici) le righe
+# dei laghi indicati con quelle ricalcolate, unendo le categorie della colonna column
+def replace_sites(frame, update, sites, column):
+    
+    categories = frame.schema[column].categories.to_list()
+    categories += [category for category in update.schema[column].categories if category not in categories]
+    
+    return pl.concat([
+        part.with_columns(pl.col(column).cast(pl.String).cast(pl.Enum(categories)))
+        for part in [frame.filter(~pl.col("siteID").is_in(sites)), update]
+    ]).sort(
+        "siteID", column
+    )
+
+# Funzione che aggiorna gli anni mancanti: quelli dei laghi con righe aggiunte vengono
+# ricalcolati sui loro valori (affected), agli altri laghi vengono aggiunti solo gli anni
+# nuovi dell'intervallo, in cui non hanno dati
+def update_missing(missing, index, affected, rows):
+    
+    sites = rows.get_column("siteID").unique()
+    years = range(
+        min(missing["years"].start, rows.get_column("year").min()),
+        max(missing["years"].stop, rows.get_column("year").max() + 1)
+    )
+    added = [year for year in years if year not in missing["years"]]
+    
+    gaps = missing["rows"]
+    
+    if added:
+        # Coppie (siteID, variable) degli altri laghi, ricavate dall'indice dei valori
+        others = set(sites.to_list())
+        pairs = pl.DataFrame(
+            [key for key in index if key[0] not in others],
+            schema = {"siteID": affected.schema["siteID"], "variable": pl.String}, orient = "row"
+        ).with_columns(pl.col("variable").cast(affected.schema["variable"]))
+        gaps = pl.concat([gaps, missing_years(rows, pairs, added)]).sort("siteID", "variable", "year")
+    
+    gaps = splice_sites(gaps, missing_years(affected, None, years), sites).rechunk()
+    
+    return {"rows": gaps, "index": build_index(gaps), "years": years}
+
+# Funzione che aggiorna i dataset con le righe aggiunte ricalcolando solo le strutture
+# dei laghi coinvolti: trend, fattori climatici ed anni mancanti dei laghi ed heatmap
+# delle loro regioni
+@instrument
+def update_data(data, rows):
     
-    # Trasformazione in valori nulli dei valori in eccesso
-    df1 =  df.select([
-        pl.col(c) if c in columns_to_keep else pl.lit(None).alias(c)
-        for c in df.columns
-    ])
+    values, lakeinformation, index, missing, heatmaps, trends, drivers = data
+    sites = rows.get_column("siteID").unique()
     
-    # Controllo per colonne non presenti a causa dei valori mancanti
-    columns_to_add = [str(year) for year in range(1985, 2010)]
+    values = merge_values(values, rows)
+    index = build_index(values)
+    affected = values.filter(pl.col("siteID").is_in(sites))
     
-    # Controlla se la colonna esiste e d eventualmente la aggiunge
-    for col in columns_to_add:
-        if col not in df1.columns:
-            df1 = df1.with_columns(pl.lit(0.5).alias(col))
+    # Cubo dei soli laghi coinvolti, su cui vengono ricalcolati trend e fattori climatici
+    local = build_cube(affected)
+    trends = replace_sites(trends, build_trends(local), sites, "variable")
+    drivers = replace_sites(drivers, build_drivers(local), sites, "driver")
     
-    # Riorganizzazione del dataframe
-    df1 = df1.unpivot(
-            on = [str(year) for year in range(1985, 2010)]
+    missing = update_missing(missing, index, affected, rows)
+    
+    # Heatmap delle regioni dei laghi coinvolti
+    members = lakeinformation.filter(
+        pl.col("region").is_in(lakeinformation.filter(pl.col("siteID").is_in(sites)).get_column("region"))
+    )
+    heatmaps = {**heatmaps, **build_heatmaps(values.filter(pl.col("siteID").is_in(members.get_column("siteID"))), members)}
+    
+    return values, lakeinformation, index, missing, heatmaps, trends, drivers
+
+# Statistiche della cache dei dataset, condivise da tutte le sessioni del processo
+@st.cache_resource
+def cache_stats():
+    return {"lock": threading.Lock(), "hits": 0, "misses": 0, "bytes": 0}
+
+# Funzione che ritorna le date di modifica dei file sorgente: cambiano quando i file
+# vengono aggiornati e invalidano così la cache
+def source_mtimes():
+    return os.path.getmtime("values.csv"), os.path.getmtime("lakeinformation.csv")
+
+# Funzione che ritorna la memoria occupata dai dataset
+def data_bytes(data):
+    
+    values, lakeinformation, index, missing, heatmaps, trends, drivers = data
+    
+    size = values.estimated_size() + lakeinformation.estimated_size() + missing["rows"].estimated_size()
+    size += sum(heatmap["matrix"].nbytes for heatmap in heatmaps.values())
+    size += trends.estimated_size() + drivers.estimated_size()
+    
+    return size
+
+# Copia unica dei dataset per processo. max_entries = 1 rimuove la versione precedente
+# quando cambiano i file, in modo che la memoria non cresca. Le aggiunte presenti al
+# caricamento vengono lette insieme al dataset compilato, quelle successive vengono
+# applicate da apply_deltas
+@st.cache_resource(max_entries = 1, show_spinner = False)
+def load_data_shared(mtimes):
+    
+    deltas = delta_files()
+    values, lakeinformation = load_data(deltas = deltas)
+    
+    # Il dataset compilato viene letto una sola volta per processo e condiviso
+    values = values.collect()
+    index = build_index(values)
+    
+    # Anni mancanti di tutti i laghi, ordinati ed indicizzati come i valori,
+    # con l'intervallo degli anni del dataset
+    years = data_years(values)
+    gaps = missing_years(values, None, years)
+    missing = {"rows": gaps, "index": build_index(gaps), "years": years}
+    
+    # Dati dell'heatmap di ciascuna regione
+    heatmaps = build_heatmaps(values, lakeinformation)
+    
+    # Trend di riscaldamento di tutti i laghi, calcolati sul cubo che viene poi liberato:
+    # i grafici leggono i valori dalla tabella tramite l'indice
+    cube = build_cube(values)
+    trends = build_trends(cube)
+    
+    # Relazione tra temperatura dell'acqua e fattori climatici di tutti i laghi
+    drivers = build_drivers(cube)
+    del cube
+    
+    data = values, lakeinformation, index, missing, heatmaps, trends, drivers
+    
+    stats = cache_stats()
+    with stats["lock"]:
+        stats["bytes"] = data_bytes(data)
+    
+    # "versions" conta le aggiunte di ciascun lago, "generation" quelle di tutto il dataset,
+    # "served" indica se i dataset sono già stati restituiti da get_data
+    return {"lock": threading.Lock(), "data": data, "deltas": set(deltas), "versions": {}, "generation": 0, "served": False}
+
+# Funzione che applica ai dataset condivisi le aggiunte non ancora caricate. I dataset
+# vengono sostituiti con una nuova versione, senza modificare quelli in uso dalle altre sessioni
+def apply_deltas(shared):
+    
+    if not [delta for delta in delta_files() if delta not in shared["deltas"]]:
+        return
+    
+    with shared["lock"]:
+        
+        # Un'altra sessione potrebbe averle già applicate
+        pending = [delta for delta in delta_files() if delta not in shared["deltas"]]
+        if not pending:
+            return
+        
+        rows = pl.scan_ipc(pending, memory_map = True).unique(
+            ["siteID", "variable", "year"], keep = "last", maintain_order = True
+        ).sort(
+            "siteID", "variable", "year"
+        ).collect()
         
-        # Eliminazione dei valori nulli
-        ).drop_nulls(
-        ).with_columns(
-            pl.lit("No data").alias("label")
-        ).rename(
-            {"variable": "year"}
-        ).with_columns(
-            pl.col("year").cast(pl.Int64).alias("year"))
+        shared["data"] = update_data(shared["data"], rows)
+        
+        for site in rows.get_column("siteID").unique():
+            shared["versions"][site] = shared["versions"].get(site, 0) + 1
+        shared["deltas"].update(pending)
+        shared["generation"] += 1
+        
+        stats = cache_stats()
+        with stats["lock"]:
+            stats["bytes"] = data_bytes(shared["data"])
+
+# Funzione che ritorna i dataset condivisi, caricandoli solo se non presenti in cache
+# o se i file sono stati modificati, ed applicando le eventuali nuove aggiunte. Insieme ai
+# dataset ritorna la loro versione, che cambia quando vengono modificati i file o aggiunte
+# nuove righe, ed il numero di aggiunte di ciascun lago
+def get_data():
+    
+    mtimes = source_mtimes()
+    shared = load_data_shared(mtimes)
+    apply_deltas(shared)
+    
+    # Dataset e versioni letti insieme, dopo le aggiunte
+    with shared["lock"]:
+        data = shared["data"]
+        version = mtimes, shared["generation"]
+        lake_versions = dict(shared["versions"])
+    
+    # La prima richiesta dei dataset appena caricati è un miss, le successive sono hit
+    stats = cache_stats()
+    with stats["lock"]:
+        if shared["served"]:
+            stats["hits"] += 1
+        else:
+            stats["misses"] += 1
+            shared["served"] = True
+    
+    return data, version, lake_versions
+
+# Cache dei grafici serializzati, condivisa da tutte le sessioni del processo.
+# Le chiavi sono (siteID, tipo di grafico, versione dei dati) e l'ordine dell'OrderedDict
+# segue l'ultimo utilizzo, in modo da rimuovere per primi i grafici meno recenti
+@st.cache_resource
+def chart_cache():
+    return {"lock": threading.Lock(), "specs": OrderedDict(), "bytes": 0, "budget": CHART_CACHE_BYTES}
+
+# Funzione che ritorna lo spec JSON di un grafico, costruendolo con build() solo
+# se non è già presente in cache per il lago e la versione dei dati indicata
+@instrument
+def cached_spec(lakeID, kind, build, version):
+    
+    cache = chart_cache()
+    key = (lakeID, kind, version)
+    
+    with cache["lock"]:
+        if key in cache["specs"]:
+            cache["specs"].move_to_end(key)
+            return debug_spec(cache["specs"][key])
     
-    return df1
+    spec = build()
+    
+    with cache["lock"]:
+        
+        # Rimozione dello stesso grafico costruito con una versione precedente dei dati:
+        # i grafici degli altri laghi restano validi
+        for old in [k for k in cache["specs"] if k[:2] == key[:2] and k[2] != version]:
+            cache["bytes"] -= len(cache["specs"].pop(old))
+        
+        if key not in cache["specs"]:
+            cache["specs"][key] = spec
+            cache["bytes"] += len(spec)
+        
+        # Rimozione dei grafici meno recenti finché la cache non rientra nel budget
+        while cache["bytes"] > cache["budget"] and len(cache["specs"]) > 1:
+            cache["bytes"] -= len(cache["specs"].popitem(last = False)[1])
+    
+    return debug_spec(spec)
 
-# Funzione che prende una stringa e ritorna la stringa con l'unità di misura (metri)
-# solo se il dato è presente
-def add_m(text):
-    if text == "Dato non presente":
-        return text
-    return text + " m"
+# Funzione che deserializza uno spec della cache e, con DEBUG, registra i byte, le righe
+# ed i dataset duplicati dello spec senza serializzarlo di nuovo
+def debug_spec(spec):
+    
+    parsed = json.loads(spec)
+    
+    if DEBUG:
+        rows, duplicates = spec_payload(parsed)
+        debug_record(rows_out = rows, bytes = len(spec), duplicates = duplicates)
+    
+    return parsed
+
+# Funzione che ritorna i contatori della cache dei dataset
+def cache_info():
+    stats = cache_stats()
+    return {"hits": stats["hits"], "misses": stats["misses"], "bytes": stats["bytes"]}
+
+# Funzione che ritorna l'intervallo degli anni coperti dai valori
+def data_years(values):
+    return range(values.get_column("year").min(), values.get_column("year").max() + 1)
+
+# Funzione che ritorna gli anni mancanti per tutte le coppie (siteID, variable) in un'unica
+# anti-join con l'intervallo degli anni. Le righe hanno valore 0.5 ed etichetta "No data"
+# per essere disegnate direttamente nei grafici
+@instrument
+def missing_years(values, pairs = None, years = None):
+    
+    # Di default vengono considerate tutte le coppie presenti nel dataset
+    if pairs is None:
+        pairs = values.select("siteID", "variable").unique()
+    
+    # Di default l'intervallo è quello degli anni presenti nel dataset
+    if years is None:
+        years = data_years(values)
+    
+    return pairs.join(
+        
+        pl.DataFrame({"year": years}, schema = {"year": values.schema["year"]}),
+        how = "cross"
+    
+    # Rimozione degli anni presenti nel dataset
+    ).join(
+        
+        values.select("siteID", "variable", "year"),
+        on = ["siteID", "variable", "year"],
+        how = "anti"
+    
+    ).sort(
+        "siteID", "variable", "year"
+    ).with_columns(
+        pl.lit(0.5).alias("value"),
+        pl.lit("No data").alias("label")
+    )
+
+# Funzione che ritorna gli anni mancanti di un lago per le variabili richieste
+def lake_missing(missing, lakeID, variables):
+    return lake_rows(missing["rows"], missing["index"], lakeID, variables)
 
-# Funzione che prende una stringa e ritorna la stringa con l'unità di misura (km³)
+# Laghi per pagina (o gruppi) dell'heatmap: oltre questo numero i laghi di una regione
+# vengono divisi in pagine o raggruppati
+HEATMAP_PAGE_LAKES = 60
+
+# Numero massimo di celle (lago × anno) dell'heatmap inviate al browser come dati del grafico:
+# oltre questo numero l'heatmap completo viene disegnato come immagine
+HEATMAP_CELL_BUDGET = 20000
+
+# Numero massimo di colonne dell'immagine dell'heatmap: oltre questo numero
+# i laghi vicini nell'ordinamento vengono mediati nella stessa colonna
+HEATMAP_IMAGE_COLUMNS = 1200
+
+# Colori della scala "blueorange" di Vega, usati per l'immagine dell'heatmap
+BLUE_ORANGE = ["#134b85", "#2f78b3", "#5da2cb", "#9dcae1", "#d2e5ef", "#f2f0eb", "#fce0ba", "#fbbf74", "#e8932f", "#c5690d", "#9a4607"]
+
+# Funzione che costruisce per ciascuna regione la matrice lago × anno delle temperature
+# dei laghi ed i possibili ordinamenti dei laghi, calcolati una sola volta
+@instrument
+def build_heatmaps(values, lakeinformation):
+    
+    # Unione dei due dataframe
+    data_temp = values.filter(
+        
+        pl.col("variable").is_in(["Lake_Temp_Summer_Satellite", "Lake_Temp_Summer_InSitu"])
+    
+    ).join(
+        
+        lakeinformation.select("siteID", "Lake_name", "region", "latitude"),
+        on = "siteID"
+    
+    )
+    
+    heatmaps = {}
+    
+    for (region,), group in data_temp.partition_by("region", as_dict = True).items():
+        
+        lakes = group.group_by("siteID").agg(
+            pl.col("Lake_name").first(), pl.col("latitude").first()
+        ).sort("Lake_name", "siteID")
+        years = np.arange(group.get_column("year").min(), group.get_column("year").max() + 1)
+        
+        # Matrice lago × anno con NaN negli anni mancanti
+        cells = group.join(
+            lakes.with_row_index("row").select("siteID", "row"), on = "siteID", maintain_order = "left"
+        )
+        matrix = np.full((lakes.height, len(years)), np.nan)
+        matrix[cells.get_column("row").to_numpy(), cells.get_column("year").to_numpy() - years[0]] = cells.get_column("value").to_numpy()
+        
+        present = ~np.isnan(matrix)
+        mean = np.where(present, matrix, 0).sum(axis = 1) / np.maximum(present.sum(axis = 1), 1)
+        
+        heatmaps[region] = {
+            "sites": lakes.get_column("siteID").to_list(),
+            "lakes": lakes.get_column("Lake_name").to_list(),
+            "years": years,
+            "matrix": matrix,
+            # Ordinamenti dei laghi: per nome, per temperatura media e per latitudine
+            "orders": {
+                "Nome": np.arange(lakes.height),
+                "Temperatura media": np.argsort(mean, kind = "stable"),
+                "Latitudine": np.argsort(lakes.get_column("latitude").to_numpy(), kind = "stable")
+            }
+        }
+    
+    return heatmaps
+
+# Funzione che ritorna le chiavi delle colonne, i nomi e la matrice dei laghi indicati (in ordine),
+# eventualmente raggruppando i laghi consecutivi in gruppi di size laghi con la temperatura media
+# del gruppo. Le chiavi sono i siteID dei laghi o il numero del gruppo, i nomi servono solo come etichette
+def heatmap_rows(heatmap, rows, size = 1):
+    
+    matrix = heatmap["matrix"][rows]
+    names = [heatmap["lakes"][row] for row in rows]
+    
+    if size <= 1:
+        return [str(heatmap["sites"][row]) for row in rows], names, matrix
+    
+    groups = np.arange(len(rows)) // size
+    present = ~np.isnan(matrix)
+    
+    total = np.zeros((groups[-1] + 1, matrix.shape[1]))
+    count = np.zeros(total.shape)
+    np.add.at(total, groups, np.where(present, matrix, 0))
+    np.add.at(count, groups, present)
+    
+    with np.errstate(invalid = "ignore"):
+        grouped = total / count
+    
+    labels = [names[start] + " – " + names[min(start + size, len(names)) - 1] for start in range(0, len(names), size)]
+    
+    return [str(group) for group in range(len(labels))], labels, grouped
+
+# Raggio medio della Terra in km
+EARTH_RADIUS_KM = 6371.0088
+
+# Lato in gradi delle celle dell'indice spaziale
+GRID_DEGREES = 1.0
+
+# Funzione che ritorna la distanza in km tra coordinate in radianti (formula dell'emisenoverso)
+def haversine(lat1, lon1, lat2, lon2):
+    
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+# Funzione che ritorna la cella della griglia di latitudine e longitudine (in gradi)
+def grid_cell(latitude, longitude):
+    
+    row = np.clip(np.floor((np.asarray(latitude) + 90) / GRID_DEGREES), 0, 180 / GRID_DEGREES - 1).astype(int)
+    column = (np.floor((np.asarray(longitude) + 180) / GRID_DEGREES) % (360 / GRID_DEGREES)).astype(int)
+    
+    return row, column
+
+# Funzione che costruisce l'indice spaziale dei laghi: i laghi vengono ordinati per cella
+# di una griglia regolare e per ogni cella viene salvato l'intervallo delle sue righe,
+# in modo che una ricerca esamini solo i laghi delle celle vicine
+@instrument
+def build_spatial_index(lakeinformation):
+    
+    row, column = grid_cell(lakeinformation["latitude"].to_numpy(), lakeinformation["longitude"].to_numpy())
+    order = np.lexsort((column, row))
+    
+    cells = {}
+    keys = list(zip(row[order].tolist(), column[order].tolist()))
+    for position, key in enumerate(keys):
+        start, _ = cells.get(key, (position, position))
+        cells[key] = (start, position + 1)
+    
+    return {
+        "sites": lakeinformation["siteID"].to_numpy()[order],
+        "latitude": np.radians(lakeinformation["latitude"].to_numpy()[order]),
+        "longitude": np.radians(lakeinformation["longitude"].to_numpy()[order]),
+        "cells": cells
+    }
+
+# Indice spaziale condiviso da tutte le sessioni, ricostruito solo quando cambiano i dati
+@st.cache_resource(max_entries = 1, show_spinner = False)
+def spatial_index(_lakeinformation, version):
+    return build_spatial_index(_lakeinformation)
+
+# Funzione che ritorna i siteID e le distanze (in km, in ordine crescente) dei laghi
+# entro radius_km dal punto indicato in gradi
+def lakes_within(spatial, latitude, longitude, radius_km):
+    
+    # Celle che coprono il cerchio: in latitudine l'ampiezza è costante,
+    # in longitudine cresce avvicinandosi ai poli
+    span = np.degrees(radius_km / EARTH_RADIUS_KM)
+    row, column = grid_cell(latitude, longitude)
+    rows = range(max(0, int(row - span // GRID_DEGREES - 1)), min(int(180 / GRID_DEGREES), int(row + span // GRID_DEGREES + 2)))
+    
+    polar = min(90, abs(latitude) + span)
+    columns_total = int(360 / GRID_DEGREES)
+    if polar >= 89 or span / np.cos(np.radians(polar)) >= 180:
+        columns = range(columns_total)
+    else:
+        width = int(span / np.cos(np.radians(polar)) // GRID_DEGREES) + 1
+        columns = [(column + offset) % columns_total for offset in range(-width, width + 1)]
+    
+    ranges = [spatial["cells"][(r, c)] for r in rows for c in set(columns) if (r, c) in spatial["cells"]]
+    if not ranges:
+        return spatial["sites"][:0], np.empty(0)
+    
+    candidates = np.concatenate([np.arange(start, stop) for start, stop in ranges])
+    distance = haversine(
+        np.radians(latitude), np.radians(longitude),
+        spatial["latitude"][candidates], spatial["longitude"][candidates]
+    )
+    
+    inside = distance <= radius_km
+    order = np.argsort(distance[inside], kind = "stable")
+    
+    return spatial["sites"][candidates[inside]][order], distance[inside][order]
+
+# Funzione che ritorna i siteID e le distanze dei k laghi più vicini al punto indicato.
+# Il raggio di ricerca raddoppia finché il cerchio non contiene almeno k laghi
+def nearest_lakes(spatial, latitude, longitude, k):
+    
+    radius = GRID_DEGREES * 111.2
+    
+    while True:
+        sites, distance = lakes_within(spatial, latitude, longitude, radius)
+        if len(sites) >= k or radius >= np.pi * EARTH_RADIUS_KM:
+            return sites[:k], distance[:k]
+        radius *= 2
+
+# Numero di laghi proposti dalla ricerca
+SEARCH_RESULTS = 20
+
+# Peso di ciascun campo nella ricerca: i nomi contano più dello stato e della regione
+SEARCH_FIELDS = {"Lake_name": 3, "Other_names": 3, "location": 1, "region": 1}
+
+# Somiglianza minima (indice di Jaccard dei trigrammi) perché un termine sia un risultato approssimato
+FUZZY_THRESHOLD = 0.4
+
+# Funzione che normalizza un testo per la ricerca: minuscole, senza accenti e con
+# la punteggiatura sostituita da spazi
+def normalize(text):
+    
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char if char.isalnum() else " " for char in text if not unicodedata.combining(char))
+    
+    return text.split()
+
+# Funzione che ritorna i trigrammi di un termine, con i bordi del termine
+def trigrams(term):
+    
+    padded = "  " + term + " "
+    
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+# Funzione che costruisce l'indice di ricerca dei laghi. Ogni termine dei campi di ricerca
+# rimanda ai laghi che lo contengono con il peso del campo. I termini ordinati permettono
+# la ricerca per prefisso con una ricerca binaria, i trigrammi la ricerca approssimata
+@instrument
+def build_search_index(lakeinformation):
+    
+    sites = lakeinformation["siteID"].to_list()
+    postings = {}
+    
+    for field, weight in SEARCH_FIELDS.items():
+        for row, text in enumerate(lakeinformation[field].cast(pl.String).to_list()):
+            for term in normalize(text or ""):
+                best = postings.setdefault(term, {})
+                best[row] = max(best.get(row, 0), weight)
+    
+    terms = sorted(postings)
+    
+    grams = {}
+    for position, term in enumerate(terms):
+        for gram in trigrams(term):
+            grams.setdefault(gram, []).append(position)
+    
+    # Etichetta mostrata per ciascun lago: il nome, gli altri nomi, lo stato e la regione
+    labels = lakeinformation.select(
+        pl.col("siteID"),
+        pl.concat_str(
+            pl.col("Lake_name"),
+            pl.when(pl.col("Other_names").is_not_null()).then(pl.format(" ({})", "Other_names")).otherwise(pl.lit("")),
+            pl.lit(" · "), pl.col("location"), pl.lit(", "), pl.col("region").cast(pl.String)
+        )
+    ).rows()
+    
+    return {
+        "sites": sites,
+        "terms": terms,
+        "postings": [postings[term] for term in terms],
+        "grams": grams,
+        "sizes": [len(trigrams(term)) for term in terms],
+        "labels": dict(labels),
+        # Laghi proposti senza una ricerca: i primi in ordine alfabetico
+        "default": lakeinformation.sort("Lake_name").get_column("siteID").head(SEARCH_RESULTS).to_list(),
+        "names": dict(zip(sites, lakeinformation["Lake_name"].to_list()))
+    }
+
+# Indice di ricerca condiviso da tutte le sessioni, ricostruito solo quando cambiano i dati
+@st.cache_resource(max_entries = 1, show_spinner = False)
+def search_index(_lakeinformation, version):
+    return build_search_index(_lakeinformation)
+
+# Funzione che ritorna il punteggio di ciascun lago per un termine della ricerca:
+# 1 per un termine uguale, 0.9 per un prefisso e meno per i termini simili,
+# moltiplicato per il peso del campo
+def term_scores(search, query):
+    
+    terms = search["terms"]
+    matches = {}
+    
+    # Termini che iniziano con la ricerca
+    start = bisect.bisect_left(terms, query)
+    end = bisect.bisect_left(terms, query + "\uffff")
+    for position in range(start, end):
+        matches[position] = 1.0 if terms[position] == query else 0.9
+    
+    # Termini con trigrammi in comune (con almeno tre caratteri nella ricerca)
+    if len(query) >= 3:
+        query_grams = trigrams(query)
+        shared = Counter(position for gram in query_grams for position in search["grams"].get(gram, ()))
+        for position, count in shared.items():
+            similarity = count / (len(query_grams) + search["sizes"][position] - count)
+            if similarity >= FUZZY_THRESHOLD:
+                matches[position] = max(matches.get(position, 0), 0.8 * similarity)
+    
+    scores = {}
+    for position, quality in matches.items():
+        for row, weight in search["postings"][position].items():
+            scores[row] = max(scores.get(row, 0), quality * weight)
+    
+    return scores
+
+# Funzione che ritorna i siteID dei k laghi più pertinenti per la ricerca:
+# ogni parola deve corrispondere ad almeno un campo ed i punteggi vengono sommati
+def search_lakes(search, query, k = SEARCH_RESULTS):
+    
+    scores = None
+    
+    for word in normalize(query):
+        word_scores = term_scores(search, word)
+        if scores is None:
+            scores = word_scores
+        else:
+            scores = {row: score + word_scores[row] for row, score in scores.items() if row in word_scores}
+    
+    if not scores:
+        return []
+    
+    names = search["names"]
+    sites = search["sites"]
+    best = sorted(scores, key = lambda row: (-scores[row], names[sites[row]]))[:k]
+    
+    return [sites[row] for row in best]
+
+# Funzione chiamata alla modifica della ricerca: il lago più pertinente diventa il lago selezionato
+def search_changed(search):
+    
+    results = search_lakes(search, st.session_state["lake_query"], 1)
+    
+    if results:
+        st.session_state["lake"] = results[0]
+
+# Funzione che prende una misura e ritorna la stringa con l'unità di misura
 # solo se il dato è presente
-def add_km3(text):
-    if text == "Dato non presente":
-        return text
-    return text + " km³"
+def format_measure(value, unit):
+    if value is None:
+        return "Dato non presente"
+    return str(value).rstrip("0").rstrip(".") + " " + unit
 
 # Funzione che ritorna l'ID del lago selezionato
 def get_lake(lakeinformation):
@@ -148,69 +1642,108 @@ def get_lake(lakeinformation):
     ## Selezione del lago
     Selezionare il lago di cui si desidera visualizzare i relativi fattori climatici e le caratteristiche geomorfometriche''')
     
-    # Scelta del lago
-    lake = col2.selectbox("Inserisci il lago:", lakeinformation.get_column("Lake_name").sort())
-
-    # Determinazione dell'ID del lago
-    return lakeinformation.filter(pl.col("Lake_name") == lake)["siteID"]
-
-# Funzione che costruisce lo scattermapbox
-def get_map_interactive(lakeID):
-    
-    # Color map personalizzato
-    color_map = {
-        "Africa": "#1f77b4",
-        "Asia": "#ff7f0e",
-        "Europa": "#2ca02c",
-        "Medio Oriente": "#d62728",
-        "Nord America nord-orientale": "#9467bd",
-        "Nord America occidentale": "#8c564b",
-        "Nord America sud-orientale": "#e377c2",
-        "Oceania": "#7f7f7f",
-        "Sud America": "#bcbd22"
-    }
+    # Ricerca del lago per nome, altro nome, stato o regione. Al browser vengono inviati
+    # solo i laghi trovati e non l'elenco completo
+    search = search_index(lakeinformation, source_mtimes())
+    
+    query = col2.text_input(
+        "Cerca il lago:", key = "lake_query", placeholder = "Nome, altro nome, stato o regione",
+        on_change = search_changed, args = (search,)
+    )
+    
+    options = search_lakes(search, query) if query.strip() else list(search["default"])
+    
+    # Il lago selezionato (anche dalla mappa) rimane tra le opzioni
+    selected = st.session_state.get("lake")
+    if selected not in search["labels"]:
+        selected = options[0] if options else search["default"][0]
+        st.session_state["lake"] = selected
+    if selected not in options:
+        options.insert(0, selected)
+    
+    # Scelta del lago tra i risultati, restituendo direttamente l'ID del lago
+    return col2.selectbox("Inserisci il lago:", options, format_func = search["labels"].get, key = "lake")
+
+# Color map personalizzato
+COLOR_MAP = {
+    "Africa": "#1f77b4",
+    "Asia": "#ff7f0e",
+    "Europa": "#2ca02c",
+    "Medio Oriente": "#d62728",
+    "Nord America nord-orientale": "#9467bd",
+    "Nord America occidentale": "#8c564b",
+    "Nord America sud-orientale": "#e377c2",
+    "Oceania": "#7f7f7f",
+    "Sud America": "#bcbd22"
+}
+
+# Funzione che ritorna il testo di hover dei laghi: il nome ed il trend della temperatura dell'acqua
+def map_hover(lakeinformation, trends = None):
+    
+    if trends is None:
+        return lakeinformation["Lake_name"].to_list()
+    
+    return lakeinformation.select("siteID", "Lake_name").join(
+        lake_temperature_trends(trends), on = "siteID", how = "left"
+    ).select(
+        pl.when(pl.col("theil_sen_slope").is_not_null()).then(
+            pl.format("{}<br>{} °C/decennio", "Lake_name", (pl.col("theil_sen_slope") * 10).round(2))
+        ).otherwise(pl.col("Lake_name"))
+    ).to_series().to_list()
+
+# Funzione che costruisce la base dello scattermapbox, uguale per tutti i laghi.
+# Tutti i laghi sono in un'unica traccia con un colore per punto
+@instrument
+def get_map_base(lakeinformation, trends = None):
     
     # Creazione della figura
     fig = go.Figure()
     
-    # Aggiungo una traccia per ciascuna regione
+    # Colore di ciascun lago in base alla regione
+    colors = lakeinformation.get_column("region").replace_strict(COLOR_MAP, default = "#000000")
     
-    for region, color in color_map.items():
-        
-        # Filtro i dati per la regione corrente
-        region_data = lakeinformation.filter(pl.col("region") == region)
+    # Aggiungo un'unica traccia con tutti i laghi
+    fig.add_trace(
         
-        # Aggiungo una traccia
-        fig.add_trace(
+        go.Scattermapbox(
             
-            go.Scattermapbox(
+            lat = lakeinformation["latitude"].to_list(),
+            lon = lakeinformation["longitude"].to_list(),
+            mode = "markers",
+            marker = dict(
                 
-                lat = region_data["latitude"],
-                lon = region_data["longitude"],
-                mode = "markers",
-                name = region, # Nome della regione mostrato nella legenda
-                marker = dict(
-                    
-                    size = 8,
-                    color = color  # Colore specifico per la regione
+                size = 8,
+                color = colors.to_list()  # Colore specifico per la regione
+                
+            ),
+            text = map_hover(lakeinformation, trends), # Testo di hover con il trend del lago
+            customdata = lakeinformation["siteID"].to_list(), # siteID letto alla selezione di un lago
+            hoverinfo = "text",
+            hoverlabel = dict( # Configurazione dell'hover
+                
+                bordercolor = "black", # Colore del bordo
+                bgcolor = "white", # Colore del background
+                font = dict(
                     
-                ),
-                text = region_data["Lake_name"], # Testo di hover
-                hoverinfo = "text",
-                hoverlabel = dict( # Configurazione dell'hover
+                    color = "black",
+                    size = 18,
+                    family = "Arial"
                     
-                    bordercolor = "black", # Colore del bordo
-                    bgcolor = "white", # Colore del background
-                    font = dict(
-                        
-                        color = "black",
-                        size = 18,
-                        family = "Arial"
-                        
-                    )
                 )
-            )
+            ),
+            showlegend = False
         )
+    )
+    
+    # Aggiungo una traccia vuota per regione per costruire la legenda
+    for region, color in COLOR_MAP.items():
+        fig.add_trace(go.Scattermapbox(
+            lat = [None],
+            lon = [None],
+            mode = "markers",
+            name = region, # Nome della regione mostrato nella legenda
+            marker = dict(size = 8, color = color)
+        ))
     
     # Configurazione della mappa
     fig.update_layout(
@@ -222,18 +1755,53 @@ def get_map_interactive(lakeID):
             
         ),
         margin = dict(l=0, r=0, t=0, b=0), # Configurazione dei margini
-        showlegend = True # Mostra la legenda
+        showlegend = True, # Mostra la legenda
+        legend = dict(itemclick = False, itemdoubleclick = False), # Le regioni si filtrano con il multiselect
+        height = 300
         
     )
     
+    # La figura viene convertita in un dizionario JSON, riutilizzabile per tutti i laghi
+    return json.loads(fig.to_json())
+
+# Base dello scattermapbox condivisa da tutte le sessioni, ricostruita solo quando cambiano i dati
+@st.cache_resource(max_entries = 1, show_spinner = False)
+def map_base(_lakeinformation, _trends, version):
+    return get_map_base(_lakeinformation, _trends)
+
+# Base dello scattermapbox con i soli laghi delle regioni indicate: gli array dei punti della
+# base vengono filtrati una volta per combinazione di regioni e condivisi da tutte le sessioni
+@st.cache_resource(max_entries = 16, show_spinner = False)
+def map_regions(_lakeinformation, _trends, version, regions):
+    
+    base = map_base(_lakeinformation, _trends, version)
+    points = base["data"][0]
+    keep = np.flatnonzero(_lakeinformation.get_column("region").is_in(list(regions)).to_numpy())
+    
+    filtered = {
+        **points,
+        **{key: [points[key][i] for i in keep] for key in ("lat", "lon", "text", "customdata")},
+        "marker": {**points["marker"], "color": [points["marker"]["color"][i] for i in keep]}
+    }
+    
+    # Nella legenda restano solo le regioni mostrate
+    legend = [trace for trace in base["data"][1:] if trace["name"] in regions]
+    
+    return {"data": [filtered] + legend, "layout": base["layout"]}
+
+# Funzione che costruisce la parte dello scattermapbox propria di un lago:
+# la traccia del lago selezionato ed il centro della mappa
+@instrument
+def get_map_selected(lakeinformation, lakeID, trends = None):
+    
     # Ricavo le informazioni del lago selezionato
     lake_selected = lakeinformation.filter(pl.col("siteID") == lakeID)
     
     # Colora il dot del lago selezionato di rosso ed evidenzia il nome del lago
-    fig.add_trace(go.Scattermapbox(
+    selected = go.Scattermapbox(
         
-        lat = lake_selected["latitude"],
-        lon = lake_selected["longitude"],
+        lat = lake_selected["latitude"].to_list(),
+        lon = lake_selected["longitude"].to_list(),
         mode = "text+markers",
         # caratteristiche del marker
         marker = dict(
@@ -243,8 +1811,9 @@ def get_map_interactive(lakeID):
             symbol = "circle"
         ),
         showlegend = False,
-        hovertext = lake_selected["Lake_name"],
-        text = lake_selected["Lake_name"],
+        hovertext = map_hover(lake_selected, trends),
+        customdata = lake_selected["siteID"].to_list(),
+        text = lake_selected["Lake_name"].to_list(),
         hoverinfo = "text",
         # caratteristiche dell'hover text
         hoverlabel = dict(
@@ -266,30 +1835,44 @@ def get_map_interactive(lakeID):
             size = 16
         ),
         textposition = "top center"
-    ))
-
-
-    # Configurazione della mappa
-    fig.update_layout(
-        mapbox = dict(
-            
-            style = "carto-positron",
-            zoom = 1,
-            # centratura della mappa in base al lago selezionato
-            center = dict(
-                
-                lat = lake_selected["latitude"][0],
-                lon = lake_selected["longitude"][0]
-            )
-        ),
-        height = 300
+    ).to_plotly_json()
+    
+    # Centro della mappa in base al lago selezionato
+    center = dict(
+        
+        lat = lake_selected["latitude"][0],
+        lon = lake_selected["longitude"][0]
     )
+    
+    return {"trace": selected, "center": center}
 
-    # Visualizzazione della mappa
-    return fig
+# Funzione che costruisce lo scattermapbox: alla base comune, eventualmente limitata ad alcune
+# regioni, vengono aggiunti solo la traccia del lago selezionato ed il centro della mappa, costruiti se non indicati
+@instrument
+def get_map_interactive(lakeinformation, lakeID, version, trends = None, selected = None, regions = None):
+    
+    if regions is None:
+        base = map_base(lakeinformation, trends, version)
+    else:
+        base = map_regions(lakeinformation, trends, version, tuple(sorted(regions)))
+    
+    if selected is None:
+        selected = get_map_selected(lakeinformation, lakeID, trends)
+    
+    # Configurazione della mappa con la centratura in base al lago selezionato.
+    # Le tracce della base non vengono copiate
+    return {
+        "data": base["data"] + [selected["trace"]],
+        "layout": {
+            **base["layout"],
+            "mapbox": {**base["layout"]["mapbox"], "center": selected["center"]}
+        }
+    }
 
-# Funzione che costruisce l'heatmap
-def get_rect(data, lakeinformation):
+# Funzione che costruisce l'heatmap. È un fragment: il cambio di regione
+# riesegue solo questa funzione e non tutta l'app
+@st.fragment
+def get_rect(heatmaps):
     
     # Costruzione di un container
     cont = st.container(border = True)
@@ -298,25 +1881,90 @@ def get_rect(data, lakeinformation):
     col1, col2 = cont.columns([0.3, 0.7])
     
     # Costruzione del selectbox delle regioni
-    region = col1.selectbox("Regione:", lakeinformation.get_column("region").unique().sort())
+    region = col1.selectbox("Regione:", sorted(heatmaps))
+    heatmap = heatmaps[region]
     
-    # Unione dei due dataframe
-    data_temp = data.join(
-        
-        lakeinformation,
-        on = "siteID"
-        
-    ).filter(
-        
-        pl.col("variable").is_in(["Lake_Temp_Summer_Satellite", "Lake_Temp_Summer_InSitu"]),
-        pl.col("region") == region
+    # Ordinamento dei laghi, precalcolato per ciascuna regione
+    order = col2.selectbox("Ordina per:", list(heatmap["orders"]))
+    rows = heatmap["orders"][order]
     
-    )
+    # Le regioni con molti laghi possono essere divise in pagine o raggruppate
+    mode = "Tutti i laghi"
+    if len(rows) > HEATMAP_PAGE_LAKES:
+        mode = cont.radio("Visualizzazione:", ["Tutti i laghi", "Pagine", "Gruppi"], horizontal = True)
+    
+    # Visualizzazione del titolo dell'heatmap
+    cont.write("Temperature medie estive dei laghi in " + region + " (°C)")
+    
+    if mode == "Pagine":
+        pages = -(-len(rows) // HEATMAP_PAGE_LAKES)
+        page = cont.number_input("Pagina (di " + str(pages) + "):", min_value = 1, max_value = pages)
+        columns, names, matrix = heatmap_rows(heatmap, rows[(page - 1) * HEATMAP_PAGE_LAKES:page * HEATMAP_PAGE_LAKES])
+    elif mode == "Gruppi":
+        columns, names, matrix = heatmap_rows(heatmap, rows, -(-len(rows) // HEATMAP_PAGE_LAKES))
+    else:
+        columns, names, matrix = heatmap_rows(heatmap, rows)
+    
+    # Visualizzazione dell'heatmap: come grafico se le celle rientrano nel budget,
+    # altrimenti come immagine costruita sul server
+    if matrix.size <= HEATMAP_CELL_BUDGET:
+        cont.altair_chart(get_heatmap(columns, names, heatmap["years"], matrix))
+    else:
+        image, low, high = get_heatmap_image(matrix)
+        cont.image(
+            image,
+            caption = f"{len(names)} laghi, dal {heatmap['years'][-1]} (in alto) al {heatmap['years'][0]}: "
+                      f"da {low:.1f} °C (blu) a {high:.1f} °C (arancione)",
+            use_container_width = True
+        )
+    
+    debug_flush("heatmap")
+
+# Funzione che costruisce l'immagine dell'heatmap dalla matrice lago × anno: i laghi sulle
+# colonne e gli anni, dal più recente, sulle righe. Ritorna l'immagine RGB ed il dominio dei colori
+@instrument
+def get_heatmap_image(matrix):
+    
+    # Oltre il numero massimo di colonne i laghi vicini vengono mediati
+    if matrix.shape[0] > HEATMAP_IMAGE_COLUMNS:
+        size = -(-matrix.shape[0] // HEATMAP_IMAGE_COLUMNS)
+        _, _, matrix = heatmap_rows({"matrix": matrix, "lakes": [""] * matrix.shape[0]}, np.arange(matrix.shape[0]), size)
+    
+    present = ~np.isnan(matrix)
+    low, high = (float(np.nanmin(matrix)), float(np.nanmax(matrix))) if present.any() else (0.0, 1.0)
+    
+    # Interpolazione della scala di colori, bianco per gli anni mancanti
+    anchors = np.array([[int(color[i:i + 2], 16) for i in (1, 3, 5)] for color in BLUE_ORANGE], dtype = np.float64)
+    position = np.where(present, (matrix - low) / max(high - low, 1e-9), 0) * (len(anchors) - 1)
+    image = np.stack([np.interp(position, np.arange(len(anchors)), anchors[:, channel]) for channel in range(3)], axis = -1)
+    image[~present] = 255
+    
+    # Anni sulle righe, dal più recente, e pixel ingranditi per rendere visibili le celle
+    image = image.transpose(1, 0, 2)[::-1].astype(np.uint8)
+    image = np.repeat(np.repeat(image, 12, axis = 0), max(1, HEATMAP_IMAGE_COLUMNS // image.shape[1]), axis = 1)
+    
+    return image, low, high
 
-    # Costruzione dell'heatmap
+# Funzione che costruisce l'heatmap dei laghi indicati a partire dalla matrice lago × anno
+@instrument
+def get_heatmap(columns, names, years, matrix):
+    
+    # Dati in formato lungo, senza gli anni mancanti: le colonne sono identificate dalla
+    # chiave (siteID o gruppo), in modo che laghi con lo stesso nome restino separati
+    lake, year = np.nonzero(~np.isnan(matrix))
+    data_temp = pl.DataFrame({
+        "column": np.array(columns, dtype = object)[lake],
+        "Lake_name": np.array(names, dtype = object)[lake],
+        "year": years[year],
+        "value": matrix[lake, year]
+    }, schema = {"column": pl.String, "Lake_name": pl.String, "year": pl.Int64, "value": pl.Float64})
+
+    # Costruzione dell'heatmap, con il nome del lago come etichetta di ciascuna colonna
     graph = alt.Chart(data_temp, title = "").mark_rect().encode(
         
-        alt.X("Lake_name:O", title = "Lago"),
+        alt.X("column:O", title = "Lago", sort = columns, axis = alt.Axis(
+            labelExpr = json.dumps(dict(zip(columns, names))) + "[datum.value]"
+        )),
         alt.Y("year:O", sort = "descending", title = ""),
         alt.Color("value:Q", title = "Temperatura", scale = alt.Scale(
             
@@ -330,30 +1978,22 @@ def get_rect(data, lakeinformation):
         
         height = 450,
         # larghezza che permette di visualizzare bene tutti gli heatmap
-        width = data_temp.select("siteID").unique().height * 13.6 + 150
+        width = len(names) * 13.6 + 150
     )
     
-    # Visualizzazione del titolo dell'heatmap
-    cont.write("Temperature medie estive dei laghi in " + region + " (°C)")
-    
     # Visualizzazione dell'heatmap
-    cont.altair_chart(graph)
+    return graph
 
 # Funzione che costruisce il grafico della temperatura dell'aria nel tempo in inverno, annuale ed in estate
-def get_lineplot_air_temp(data, lakeID):
+@instrument
+def get_lineplot_air_temp(data, index, lakeID):
     
-    # Filtro dei dati per semplificarne l'utilizzo
-    data_temp = data.filter(
-        pl.col("variable").is_in(["Air_Temp_Mean_Annual_CRU", "Air_Temp_Mean_Summer_CRU", "Air_Temp_Mean_Winter_CRU"]),
-        pl.col("siteID") == lakeID
-        
-    # Cambiamento del nome della variabile da vedere nella legenda
-    ).with_columns(
-        pl.col("variable").replace(
-            ["Air_Temp_Mean_Annual_CRU", "Air_Temp_Mean_Summer_CRU", "Air_Temp_Mean_Winter_CRU"],
-            ["Annuale", "Estiva", "Invernale"]
-        )
-    )
+    # Selezione dei dati per semplificarne l'utilizzo. Il nome da vedere
+    # nella legenda è nella colonna "season". Vengono inviate solo le colonne usate nel grafico
+    data_temp = lake_rows(
+        data, index, lakeID,
+        ["Air_Temp_Mean_Annual_CRU", "Air_Temp_Mean_Summer_CRU", "Air_Temp_Mean_Winter_CRU"]
+    ).select("year", "value", "season")
     
     # Crea un selection point che identifica il punto più vicino al cursore basato sull'asse X "Anno"
     nearest = alt.selection_point(
@@ -364,22 +2004,19 @@ def get_lineplot_air_temp(data, lakeID):
         empty = False
     )
 
-    # Il grafico di base con le temperature
-    line = alt.Chart(
-        data_temp
-    ).mark_line().encode(
+    # Il grafico di base con le temperature. I layer non hanno dati propri:
+    # usano tutti il dataset registrato una sola volta nel grafico finale
+    line = alt.Chart().mark_line().encode(
         # Asse X
         alt.X("year:Q", axis = alt.Axis(format = ".0f"), scale = alt.Scale(zero = False), title = "Anno"),
         # Asse Y
         alt.Y("value:Q", scale = alt.Scale(zero = False), title = "Temperatura (°C)"),
         # Colori delle linee
-        alt.Color("variable", title = "Temperatura media")
+        alt.Color("season:N", title = "Temperatura media")
     )
 
     # Selettore trasparente del grafico. Ricava il valore X in cui si trova il cursore
-    selectors = alt.Chart(
-        data_temp
-    ).mark_point().encode(
+    selectors = alt.Chart().mark_point().encode(
         
         alt.X("year:Q", title = "Anno"),
         opacity = alt.value(0)
@@ -399,13 +2036,11 @@ def get_lineplot_air_temp(data, lakeID):
         dx = 5,
         dy = -5
     ).encode(
-        text = alt.condition(nearest, "value", alt.value(" "))
+        text = alt.condition(nearest, "value:Q", alt.value(" "))
     )
 
     # Disegna la linea verticale in corrispondenza dell'anno selezionato con il cursore
-    rules = alt.Chart(
-        data_temp
-    ).mark_rule(color = "gray").encode(
+    rules = alt.Chart().mark_rule(color = "gray").encode(
         alt.X("year:Q", title = "Anno"),
         opacity = alt.value(0.3)
     ).transform_filter(
@@ -414,7 +2049,7 @@ def get_lineplot_air_temp(data, lakeID):
     
     # Grafico finale che combina i grafici precedenti
     chart = alt.layer(
-      line, selectors, points, rules, text
+      line, selectors, points, rules, text, data = data_temp
     ).properties(
         height=300
     )
@@ -423,18 +2058,28 @@ def get_lineplot_air_temp(data, lakeID):
     return chart
 
 # Funzione che costruisce i tre barplot della copertura nuvolosa in inverno, annuale ed in estate
-def get_barplot_cloud(data, lakeID):
-    
-    # Suddivisione del dataframe per semplificarne l'utilizzo
-    data_winter = data.filter(
-        pl.col("variable") == "Cloud_Cover_Winter",
-        pl.col("siteID") == lakeID)
-    data_annual = data.filter(
-        pl.col("variable") == "Cloud_Cover_Annual",
-        pl.col("siteID") == lakeID)
-    data_summer = data.filter(
-        pl.col("variable") == "Cloud_Cover_Summer",
-        pl.col("siteID") == lakeID)
+@instrument
+def get_barplot_cloud(data, index, missing, lakeID):
+    
+    # Anni mancanti per ciascuna stagione
+    missing_winter = lake_missing(missing, lakeID, ["Cloud_Cover_Winter"])
+    missing_annual = lake_missing(missing, lakeID, ["Cloud_Cover_Annual"])
+    missing_summer = lake_missing(missing, lakeID, ["Cloud_Cover_Summer"])
+    
+    # Suddivisione del dataframe per semplificarne l'utilizzo: per ciascuna stagione un unico
+    # dataset con i valori presenti e gli anni mancanti (con l'etichetta "No data"),
+    # condiviso dal barplot e dal testo
+    data_winter, data_annual, data_summer = [
+        pl.concat([
+            lake_rows(data, index, lakeID, [variable]).select("year", "value"),
+            gaps.select("year", "value", "label")
+        ], how = "diagonal")
+        for variable, gaps in [
+            ("Cloud_Cover_Winter", missing_winter),
+            ("Cloud_Cover_Annual", missing_annual),
+            ("Cloud_Cover_Summer", missing_summer)
+        ]
+    ]
     
     # Creo un select point per marcare una barra quando selezionata
     select = alt.selection_point(name = "select", on = "click")
@@ -455,12 +2100,15 @@ def get_barplot_cloud(data, lakeID):
         .otherwise(alt.value(0))
     )
 
-    # Barplot della copertura nuvolosa in inverno
-    cloud1 = alt.Chart(data_winter,
+    # Barplot della copertura nuvolosa in inverno: solo gli anni con il valore
+    cloud1 = alt.Chart(
         
         # Altezza del grafico
         height=200
     
+    ).transform_filter(
+        "!isValid(datum.label)"
+    
     # Definizione delle barre
     ).mark_bar(
         
@@ -472,7 +2120,7 @@ def get_barplot_cloud(data, lakeID):
     ).encode(
         
         # Asse X
-        alt.X("year", axis = alt.Axis(format = ".0f"), scale = alt.Scale(zero = False), title = ""),
+        alt.X("year:Q", axis = alt.Axis(format = ".0f"), scale = alt.Scale(zero = False), title = ""),
         
         # Asse Y
         alt.Y(
@@ -482,7 +2130,7 @@ def get_barplot_cloud(data, lakeID):
         ),
         
         # Definizione delle informazioni mostrate sopra il cursore al suo passaggio
-        tooltip = [alt.Tooltip("value", title = "Percentuale"), alt.Tooltip("year", title = "Anno")],
+        tooltip = [alt.Tooltip("value:Q", title = "Percentuale"), alt.Tooltip("year:Q", title = "Anno")],
         
         # Definizione dell'opacità delle barre quando una viene selezionata
         fillOpacity = alt.when(select).then(alt.value(1)).otherwise(alt.value(0.3)),
@@ -494,48 +2142,52 @@ def get_barplot_cloud(data, lakeID):
     ).add_params(select, highlight)
 
     # Barplot della copertura nuvolosa media annuale
-    cloud2 = alt.Chart(data_annual,
+    cloud2 = alt.Chart(
             height = 200
+    ).transform_filter(
+        "!isValid(datum.label)"
     ).mark_bar(
         fill = "#0050a3",
         stroke = "black",
         cursor = "pointer",
         size = 25
     ).encode(
-        alt.X("year", axis = alt.Axis(format = ".0f"), scale = alt.Scale(zero = False), title = ""),
+        alt.X("year:Q", axis = alt.Axis(format = ".0f"), scale = alt.Scale(zero = False), title = ""),
         alt.Y(
             "value:Q",
             scale = alt.Scale(domain = [0, 1]),
             axis = alt.Axis(title = "Annuale", titleColor = "black", titleFontWeight = "bold")
         ),
-        tooltip = [alt.Tooltip("value", title = "Percentuale"), alt.Tooltip("year", title = "Anno")],
+        tooltip = [alt.Tooltip("value:Q", title = "Percentuale"), alt.Tooltip("year:Q", title = "Anno")],
         fillOpacity = alt.when(select).then(alt.value(1)).otherwise(alt.value(0.3)),
         strokeWidth = stroke_width,
     ).add_params(select, highlight)
 
     # Barplot della copertura nuvolosa in inverno
-    cloud3 = alt.Chart(data_summer,
+    cloud3 = alt.Chart(
             height=200
+    ).transform_filter(
+        "!isValid(datum.label)"
     ).mark_bar(
         fill="#6baedc",
         stroke="black",
         cursor="pointer",
         size=25
     ).encode(
-        alt.X("year", axis = alt.Axis(format = ".0f"), scale = alt.Scale(zero = False), title = ""),
+        alt.X("year:Q", axis = alt.Axis(format = ".0f"), scale = alt.Scale(zero = False), title = ""),
         alt.Y(
             "value:Q",
             scale = alt.Scale(domain = [0, 1]),
             axis = alt.Axis(title = "Estate", titleColor = "black", titleFontWeight = "bold")
         ),
-        tooltip = [alt.Tooltip("value", title = "Percentuale"), alt.Tooltip("year", title = "Anno")],
+        tooltip = [alt.Tooltip("value:Q", title = "Percentuale"), alt.Tooltip("year:Q", title = "Anno")],
         fillOpacity = alt.when(select).then(alt.value(1)).otherwise(alt.value(0.3)),
         strokeWidth = stroke_width,
     ).add_params(select, highlight)
 
     # Inserimento del testo "No data" nei valori mancanti del barplot invernale
-    text1 = alt.Chart(
-        convert_null(data_winter)
+    text1 = alt.Chart().transform_filter(
+        "isValid(datum.label)"
         
     # Definizione del testo
     ).mark_text(
@@ -546,14 +2198,14 @@ def get_barplot_cloud(data, lakeID):
         color = "black",
         angle = 90 # Rotazione del testo per renderlo verticale
     ).encode(
-        x = "year",
-        y = "value",
-        text = "label"
+        x = "year:Q",
+        y = "value:Q",
+        text = "label:N"
     )
     
     # Inserimento del testo "No data" nei valori mancanti del barplot annuale
-    text2 = alt.Chart(
-        convert_null(data_annual)
+    text2 = alt.Chart().transform_filter(
+        "isValid(datum.label)"
         
     ).mark_text(
         align = "left",
@@ -563,14 +2215,14 @@ def get_barplot_cloud(data, lakeID):
         color = "black",
         angle = 90
     ).encode(
-        x = "year",
-        y = "value",
-        text = "label"
+        x = "year:Q",
+        y = "value:Q",
+        text = "label:N"
     )
 
     # Inserimento del testo "No data" nei valori mancanti del barplot estivo
-    text3 = alt.Chart(
-        convert_null(data_summer)
+    text3 = alt.Chart().transform_filter(
+        "isValid(datum.label)"
         
     ).mark_text(
         align = "left",
@@ -580,40 +2232,35 @@ def get_barplot_cloud(data, lakeID):
         color = "black",
         angle = 90
     ).encode(
-        x = "year",
-        y = "value",
-        text = "label"
+        x = "year:Q",
+        y = "value:Q",
+        text = "label:N"
     )
 
     charts = []
     
-    # Visualizzazione dei tre barplot
-    if convert_null(data_winter).is_empty(): charts.append(cloud1)
-    else: charts.append(cloud1 + text1)
+    # Visualizzazione dei tre barplot, con il dataset della stagione registrato una sola volta
+    if missing_winter.is_empty(): charts.append(alt.layer(cloud1, data = data_winter))
+    else: charts.append(alt.layer(cloud1, text1, data = data_winter))
     
-    if convert_null(data_annual).is_empty(): charts.append(cloud2)
-    else: charts.append(cloud2 + text2)
+    if missing_annual.is_empty(): charts.append(alt.layer(cloud2, data = data_annual))
+    else: charts.append(alt.layer(cloud2, text2, data = data_annual))
     
-    if convert_null(data_summer).is_empty(): charts.append(cloud3)
-    else: charts.append(cloud3 + text3)
+    if missing_summer.is_empty(): charts.append(alt.layer(cloud3, data = data_summer))
+    else: charts.append(alt.layer(cloud3, text3, data = data_summer))
     
     return charts
 
 # Funzione che costruisce il grafico della radiazione totale in inverno, annuale ed in estate
-def get_lineplot_radiation(data, lakeID):
-    
-    # Filtro del dataframe per semplificarne l'utilizzo
-    data_rad = data.filter(
-        pl.col("variable").is_in(["Radiation_Total_Summer", "Radiation_Total_Annual", "Radiation_Total_Winter"]),
-        pl.col("siteID") == lakeID
+@instrument
+def get_lineplot_radiation(data, index, lakeID):
     
-    # Cambiamento del nome della variabile da vedere nella legenda
-    ).with_columns(
-        pl.col("variable").replace(
-            ["Radiation_Total_Summer", "Radiation_Total_Annual", "Radiation_Total_Winter"],
-            ["Estiva", "Annuale", "Invernale"]
-        )
-    )
+    # Selezione dei dati per semplificarne l'utilizzo. Il nome da vedere
+    # nella legenda è nella colonna "season"
+    data_rad = lake_rows(
+        data, index, lakeID,
+        ["Radiation_Total_Summer", "Radiation_Total_Annual", "Radiation_Total_Winter"]
+    ).select("year", "value", "season")
     
     # Creazione di un dominio per una migliore visualizzazione del grafico
     custom_domain = [
@@ -647,7 +2294,7 @@ def get_lineplot_radiation(data, lakeID):
         # Asse Y
         alt.Y("value:Q", title = "Radiazioni", scale = alt.Scale(domain = custom_domain)).stack(None),
         # Colori delle linee
-        alt.Color("variable", title = "Quantità totale di radiazioni"),
+        alt.Color("season:N", title = "Quantità totale di radiazioni"),
         # Rimozione del tootip
         tooltip = alt.value(None)
         
@@ -659,82 +2306,179 @@ def get_lineplot_radiation(data, lakeID):
     return chart
 
 # Funzione che costruisce il grafico della temperatura del lago considerando i valori mancanti
-def get_lineplot_lake(data, lakeID):
+@instrument
+def get_lineplot_lake(data, index, missing, lakeID):
     
-    # Filtro del dataframe per semplificarne l'utilizzo
-    data1 = data.filter(
-        pl.col("siteID") == lakeID,
-        pl.col("variable").is_in(["Lake_Temp_Summer_Satellite", "Lake_Temp_Summer_InSitu"])
-    )
+    # Selezione del dataframe per semplificarne l'utilizzo
+    data1 = lake_rows(data, index, lakeID, ["Lake_Temp_Summer_Satellite", "Lake_Temp_Summer_InSitu"])
     
-    # Creazione di una matrice dei valori mancanti (Verrà utilizzata solo la colonna "year")
-    converted = convert_null(data1)
+    # Anni mancanti del lago (Verranno utilizzate solo le colonne "year" e "label")
+    converted = lake_missing(missing, lakeID, ["Lake_Temp_Summer_Satellite", "Lake_Temp_Summer_InSitu"])
     
-    # Creazione di una matrice con i valori mancanti formattata come il dataframe originale
-    missing_data = pl.DataFrame(
-        {
-            "variable": [data1["variable"][0]] * converted.height,
-            "year": converted["year"],
-            "siteID": [data1["siteID"][0]] * converted.height,
-            "value": [None] * converted.height
-        }
-    )
-    
-    # Inserimento dei valori mancanti nel dataframe originale
-    data1 = data1.vstack(missing_data)
+    # Inserimento dei valori mancanti nel dataframe originale: negli anni mancanti "value"
+    # rimane nullo ed interrompe la linea, "label" è nullo negli anni presenti.
+    # È l'unico dataset del grafico, condiviso dai due layer
+    data1 = pl.concat([data1.select("year", "value"), converted.select("year", "label")], how = "diagonal")
     
     # Creazione del grafico di dispersione
-    point = alt.Chart(
-        data1
-    ).mark_line(point=alt.OverlayMarkDef(filled = False, fill = "white")).encode(
+    point = alt.Chart().mark_line(point=alt.OverlayMarkDef(filled = False, fill = "white")).encode(
         # Asse X
         alt.X("year:Q", 
             axis = alt.Axis(format = ".0f"),
             title = "Anno", 
-            scale = alt.Scale(domain = [1984, 2010])
+            scale = alt.Scale(domain = [missing["years"].start - 1, missing["years"].stop])
         ),
         # Asse Y
         alt.Y("value:Q", title = "Temperatura (°C)", scale = alt.Scale(zero = False)),
         
-    ).properties(
-        height = 300
     )
     
     # Controllo della presenza di valori mancanti
-    if converted.is_empty(): return point
+    if converted.is_empty(): return alt.layer(point, data = data1).properties(height = 300)
     else:
     
-        graph = point
+        # Creazione delle colonne che segnalano l'assenza del dato in un unico layer:
+        # dagli anni mancanti vengono calcolati gli estremi di ciascuna colonna
+        rect = alt.Chart().transform_filter(
+            "isValid(datum.label)"
+        ).transform_calculate(
+            x1 = "datum.year - 0.5",
+            x2 = "datum.year + 0.5"
+        ).mark_rect(opacity = 0.3).encode(
+            x = "x1:Q",
+            x2 = "x2:Q",
+            color = alt.ColorValue("#FF0000"),
+            tooltip = "label:N"
+        )
         
-        # Creazione di una colonna che segnala l'assenza del dato in corrispondenza dell'anno
-        for year in converted["year"]:
-            
-            # Creazione di un dataframe per la costruzione della colonna
-            rect_data = pl.DataFrame({
-                "x1": [year - 0.5],
-                "x2": [year + 0.5],
-                "label": "No data"
-            })
-            
-            # Creazione della colonna
-            rect = alt.Chart(rect_data).mark_rect(opacity = 0.3).encode(
-                x = "x1",
-                x2 = "x2",
-                color = alt.ColorValue("#FF0000"),
-                tooltip = "label"
-            )
-            
-            # Inserimento della colonna sul grafico di dispersione
-            graph = graph + rect
+        # Inserimento delle colonne sul grafico di dispersione
+        graph = alt.layer(point, rect, data = data1).properties(height = 300)
         
         # Visualizzazione del grafico finale
         return graph
 
-# Funzione che costruisce la mappa per visualizzare il metodo di campionamento
-def get_map_method(countries_data, lakeinformation):
+# Metriche del confronto tra laghi con le relative variabili (valori estivi) ed unità di misura
+COMPARISON = {
+    "Temperatura dell'acqua (°C)": ["Lake_Temp_Summer_InSitu", "Lake_Temp_Summer_Satellite"],
+    "Temperatura dell'aria (°C)": ["Air_Temp_Mean_Summer_CRU"],
+    "Copertura nuvolosa": ["Cloud_Cover_Summer"],
+    "Radiazione solare (W/m²)": ["Radiation_Total_Summer"]
+}
+
+# Tratteggi delle linee del confronto: dopo i 20 colori della palette le serie
+# ripartono dal primo colore con il tratteggio successivo
+COMPARISON_DASHES = [[1, 0], [6, 3], [2, 2]]
+
+# Funzione che costruisce il grafico di confronto tra più laghi: un'unica figura con una riga
+# per metrica (con la propria scala) ed una combinazione di colore e tratteggio per lago
+@instrument
+def get_lineplot_comparison(data, index, lakeinformation, lakeIDs):
+    
+    metrics = {variable: metric for metric, variables in COMPARISON.items() for variable in variables}
+    
+    # Nome di ciascun lago, con lo stato se tra i laghi scelti ce n'è un altro con lo stesso nome
+    names = lakeinformation.filter(pl.col("siteID").is_in(lakeIDs)).select(
+        pl.col("siteID"),
+        pl.when(pl.col("Lake_name").is_duplicated()).then(
+            pl.format("{} ({})", "Lake_name", "location")
+        ).otherwise(pl.col("Lake_name")).alias("Lake_name")
+    )
+    
+    # Serie di tutti i laghi e di tutte le metriche lette insieme
+    data_compare = lakes_rows(data, index, lakeIDs, list(metrics)).join(
+        
+        names,
+        on = "siteID"
     
-    # Ricavo le informazioni per costruire la mappa del mondo
-    countries = alt.topo_feature(countries_data.world_110m.url, "countries")
+    ).select(
+        pl.col("Lake_name"),
+        pl.col("year"),
+        pl.col("value"),
+        pl.col("variable").cast(pl.String).replace_strict(metrics, return_dtype = pl.Enum(list(COMPARISON))).alias("metric")
+    )
+    
+    return alt.Chart(
+        data_compare
+    ).mark_line(point = True).encode(
+        # Asse X
+        alt.X("year:Q", axis = alt.Axis(format = ".0f"), scale = alt.Scale(zero = False), title = "Anno"),
+        # Asse Y con la scala di ciascuna metrica
+        alt.Y("value:Q", scale = alt.Scale(zero = False), title = None),
+        # Un colore ed un tratteggio per lago, in un'unica legenda
+        alt.Color("Lake_name:N", title = "Lago", scale = alt.Scale(scheme = "tableau20"), legend = alt.Legend(symbolType = "stroke")),
+        alt.StrokeDash(
+            "Lake_name:N", title = "Lago", legend = alt.Legend(symbolType = "stroke"),
+            scale = alt.Scale(range = [dash for dash in COMPARISON_DASHES for _ in range(20)])
+        ),
+        tooltip = [
+            alt.Tooltip("Lake_name:N", title = "Lago"),
+            alt.Tooltip("year:Q", title = "Anno"),
+            alt.Tooltip("value:Q", title = "Valore", format = ".2f")
+        ]
+    ).properties(
+        width = 800,
+        height = 200
+    ).facet(
+        row = alt.Row("metric:N", title = None, sort = list(COMPARISON), header = alt.Header(labelAngle = 0, labelAlign = "left"))
+    ).resolve_scale(
+        y = "independent"
+    )
+
+# Funzione che mostra il confronto tra più laghi. È un fragment: la selezione
+# dei laghi riesegue solo questa sezione
+@st.fragment
+def comparison_section(data, lakeinformation, index):
+    
+    st.divider()
+    
+    col1, col2, col3 = st.columns([0.15, 0.7, 0.15])
+    
+    col2.markdown("""
+    ## Confronto tra laghi
+    Selezionare i laghi da confrontare: per ciascuna metrica estiva le serie dei laghi sono riportate nello stesso grafico
+    """)
+    
+    # Ricerca dei laghi con lo stesso indice della scelta del lago: al browser vengono
+    # inviati solo i laghi trovati ed i laghi già scelti, non l'elenco completo
+    search = search_index(lakeinformation, source_mtimes())
+    
+    query = col2.text_input("Cerca i laghi da confrontare:", key = "comparison_query", placeholder = "Nome, altro nome, stato o regione")
+    
+    options = search_lakes(search, query) if query.strip() else list(search["default"])
+    
+    # I laghi già scelti rimangono tra le opzioni
+    chosen = [lake for lake in st.session_state.get("comparison_lakes", []) if lake in search["labels"]]
+    st.session_state["comparison_lakes"] = chosen
+    options = chosen + [lake for lake in options if lake not in chosen]
+    
+    # Scelta dei laghi tra i risultati, restituendo direttamente gli ID dei laghi
+    lakeIDs = col2.multiselect("Laghi da confrontare:", options, format_func = search["labels"].get, key = "comparison_lakes")
+    
+    if not lakeIDs:
+        col2.info("Nessun lago selezionato")
+        return
+    
+    col2.altair_chart(get_lineplot_comparison(data, index, lakeinformation, lakeIDs))
+    
+    debug_flush("comparison")
+
+# Funzione che carica la topologia semplificata del mondo salvata in locale.
+# Viene letta una sola volta per processo
+@st.cache_resource
+def load_world(source = "world-110m.json"):
+    with open(source) as f:
+        return json.load(f)
+
+# Funzione che costruisce la mappa per visualizzare il metodo di campionamento
+@instrument
+def get_map_method(world, lakeinformation):
+    
+    # Ricavo le informazioni per costruire la mappa del mondo, inserite direttamente
+    # nel grafico senza scaricarle da internet
+    countries = alt.InlineData(
+        values = world,
+        format = alt.DataFormat(type = "topojson", feature = "countries")
+    )
 
     # Costruzione della mappa del mondo
     background = alt.Chart(countries).mark_geoshape(
@@ -752,7 +2496,7 @@ def get_map_method(countries_data, lakeinformation):
         latitude = "latitude:Q",
         size = alt.value(15),
         # Distinzione del metodo per colori
-        color = alt.Color("source", title = "Metodo di campionamento").scale(range=["blue", "red"]),
+        color = alt.Color("source:N", title = "Metodo di campionamento").scale(range=["blue", "red"]),
         # Modifica del tooltip
         tooltip = [alt.Tooltip("Lake_name", title = "Nome"),
                    alt.Tooltip("location", title="Stato"),
@@ -763,11 +2507,9 @@ def get_map_method(countries_data, lakeinformation):
         # width=500,
         # height=400
     )
-    
-    col1, col2, col3 = st.columns([0.15, 0.7, 0.15])
 
     # Visualizzazione del grafico finale
-    col2.altair_chart(background + figure, use_container_width=True)
+    return background + figure
 
 # Funzione che ritorna il titolo e l'introduzione
 def start_page():
@@ -795,7 +2537,7 @@ def start_page():
     col2.divider()
 
 # Funzione che ritorna il contesto e la sintesi
-def background():
+def background(heatmaps):
 
     col1, col2, col3 = st.columns([0.15, 0.7, 0.15])
     
@@ -829,12 +2571,12 @@ def background():
     """)
     
     # Visualizzazione dell'heatmap con selezione per regione
-    get_rect(data, lakeinformation)
+    get_rect(heatmaps)
     
     st.divider()
 
 # Funzione che ritorna i metodi di campionamento della temperatura dell'acqua
-def methods():
+def methods(lakeinformation):
     
     col1, col2, col3 = st.columns([0.15, 0.7, 0.15])
     
@@ -855,161 +2597,366 @@ def methods():
     """)
 
     # Visualizzazione della mappa per vedere i metodi di campionamento
-    get_map_method(countries_data, lakeinformation)
+    col1, col2, col3 = st.columns([0.15, 0.7, 0.15])
+    col2.altair_chart(get_map_method(load_world(), lakeinformation), use_container_width=True)
     
     st.divider()
 
-# Caricamento dei dataset
-data, lakeinformation = load_data()
+# Funzione chiamata alla selezione di un punto dello scattermapbox: il lago cliccato
+# diventa il lago del selectbox
+def select_from_map(lakeinformation):
+    
+    points = st.session_state["lake_map"]["selection"]["points"]
+    sites = [point["customdata"] for point in points if point.get("customdata") is not None]
+    
+    if sites:
+        site = sites[0][0] if isinstance(sites[0], list) else sites[0]
+        if not lakeinformation.filter(pl.col("siteID") == site).is_empty():
+            st.session_state["lake"] = site
 
-# Inserimento del titolo e dell'introduzione
-start_page()
+# Funzione che mostra i laghi vicini al lago selezionato, entro un raggio o i più vicini
+def nearby_lakes(lakeinformation, lake):
+    
+    spatial = spatial_index(lakeinformation, source_mtimes())
+    latitude, longitude = lake["latitude"][0], lake["longitude"][0]
+    
+    col1, col2, col3 = st.columns([0.15, 0.7, 0.15])
+    col2.markdown("### Laghi vicini")
+    
+    mode = col2.radio("Ricerca:", ["Entro un raggio", "Più vicini"], horizontal = True)
+    
+    # Il lago selezionato viene escluso dai risultati
+    if mode == "Entro un raggio":
+        radius = col2.slider("Raggio (km):", 50, 2000, 200, step = 50)
+        sites, distance = lakes_within(spatial, latitude, longitude, radius)
+    else:
+        k = col2.slider("Numero di laghi:", 1, 30, 5)
+        sites, distance = nearest_lakes(spatial, latitude, longitude, k + 1)
+    
+    nearby = pl.DataFrame({"siteID": sites, "distance": distance}).filter(
+        pl.col("siteID") != lake["siteID"][0]
+    ).head(
+        len(sites) if mode == "Entro un raggio" else k
+    ).join(
+        lakeinformation.select("siteID", "Lake_name", "location", "region"), on = "siteID", maintain_order = "left"
+    ).select(
+        pl.col("Lake_name").alias("Lago"),
+        pl.col("location").alias("Stato"),
+        pl.col("region").alias("Regione"),
+        pl.col("distance").round(1).alias("Distanza (km)")
+    )
+    
+    if nearby.is_empty():
+        col2.info("Nessun lago trovato")
+    else:
+        col2.dataframe(nearby, hide_index = True, use_container_width = True)
 
-# Inserimento del contesto e sintesi
-background()
+# Funzione che mostra la selezione del lago, lo scattermapbox e i grafici del lago selezionato.
+# È un fragment: il cambio di lago riesegue solo questa sezione
+@st.fragment
+def lake_section(data, lakeinformation, index, missing, trends, version, lake_versions):
+    
+    # Scelta del lago
+    lakeID = get_lake(lakeinformation)
 
-# Inserimento dei metodi di campionamento della temperature dell'acqua
-methods()
+    lake = lakeinformation.filter(pl.col("siteID") == lakeID)
+    
+    # Trend della temperatura dell'acqua (in base al metodo di campionamento) e dell'aria in estate
+    trend = lake_trends(trends, lakeID)
+    lake_trend = trend.get("Lake_Temp_Summer_Satellite" if lake["source"][0] == "satellite" else "Lake_Temp_Summer_InSitu")
+    air_trend = trend.get("Air_Temp_Mean_Summer_CRU")
 
-# Scelta del lago
-lakeID = get_lake(lakeinformation)
+    # Versioni dei dati usate dalla cache dei grafici: la mappa mostra i trend di tutti i laghi,
+    # gli altri grafici dipendono solo dai dati del lago e dall'intervallo degli anni
+    lake_data = version[0], missing["years"], lake_versions.get(lakeID, 0)
 
-lake = lakeinformation.filter(pl.col("siteID") == lakeID)
+    # Visualizzazione dello scattermapbox: cliccando un lago questo viene selezionato.
+    # La base è condivisa da tutti i laghi, in cache per lago ci sono solo la traccia del lago ed il centro
+    selected = cached_spec(lakeID, "map", lambda: json.dumps(get_map_selected(lakeinformation, lakeID, trends)), version)
+    
+    # Regioni mostrate sulla mappa: con tutte le regioni viene usata la base completa
+    regions = st.multiselect("Regioni sulla mappa:", list(COLOR_MAP), default = list(COLOR_MAP), key = "map_regions")
+    
+    st.plotly_chart(
+        get_map_interactive(lakeinformation, lakeID, version, trends, selected, None if len(regions) == len(COLOR_MAP) else regions),
+        use_container_width = True,
+        key = "lake_map",
+        on_select = functools.partial(select_from_map, lakeinformation),
+        selection_mode = "points"
+    )
+    
+    # Ricerca dei laghi vicini con l'indice spaziale
+    nearby_lakes(lakeinformation, lake)
 
-# Visualizzazione dello scattermapbox
-st.plotly_chart(get_map_interactive(lakeID), use_container_width = True)
+    # Creazione di colonne per una visualizzazione migliore
+    col1, col2, col3, col4 = st.columns([0.05, 0.7, 0.05, 0.2])
 
-# Creazione di colonne per una visualizzazione migliore
-col1, col2, col3, col4 = st.columns([0.05, 0.7, 0.05, 0.2])
+    # Costruzione della colonna a destra per visualizzare le informazioni del lago selezionato
+    col4.markdown(
+        """
+        <style>
+            .legend-section {
+                font-family: Arial, sans-serif;
+                margin-bottom: 20px;
+            }
+            .legend-title {
+                font-size: 20px;
+                font-weight: bold;
+                margin-bottom: 10px;
+            }
+            .legend-item {
+                font-size: 14px;
+                margin-bottom: 5px;
+            }
+            .legend-name {
+                font-size: 20px;
+                margin-bottom: 5px;
+            }
+            .color { color: #dc8624; }
+        </style>
 
-# Costruzione della colonna a destra per visualizzare le informazioni del lago selezionato
-col4.markdown(
-    """
-    <style>
-        .legend-section {
-            font-family: Arial, sans-serif;
-            margin-bottom: 20px;
-        }
-        .legend-title {
-            font-size: 20px;
-            font-weight: bold;
-            margin-bottom: 10px;
-        }
-        .legend-item {
-            font-size: 14px;
-            margin-bottom: 5px;
-        }
-        .legend-name {
-            font-size: 20px;
-            margin-bottom: 5px;
-        }
-        .color { color: #dc8624; }
-    </style>
-
-    <div class="legend-section">
-        <div class="legend-title"><span class="color">Nome del lago</span></div>
-        <div class="legend-name">""" + lake["Lake_name"][0] + """</div>
-    </div>
-
-    <div class="legend-section">
-        <div class="legend-title"><span class="color">Tipo di lago</span></div>
-        <div class="legend-item">""" + lake["lake_or_reservoir"][0] + """</div>
-    </div>
-
-    <div class="legend-section">
-        <div class="legend-title"><span class="color">Stato</span></div>
-        <div class="legend-item">""" + lake["location"][0] + """</div>
-    </div>
-    
-    <div class="legend-section">
-        <div class="legend-title"><span class="color">Regione</span></div>
-        <div class="legend-item">""" + lake["region"][0] + """</div>
-    </div>
-    
-    <div class="legend-section">
-        <div class="legend-title"><span class="color">Metodo di campionamento</span></div>
-        <div class="legend-item">""" + lake["source"][0].capitalize() + """</div>
-    </div>
-    
-    <div class="legend-section">
-        <div class="legend-title"><span class="color">Elevazione dal livello del mare</span></div>
-        <div class="legend-item">""" + str(lake["elevation_m"][0]).rstrip('0').rstrip('.') + """ m</div>
-    </div>
-    
-    <div class="legend-section">
-        <div class="legend-title"><span class="color">Profondità media</span></div>
-        <div class="legend-item">""" + add_m(str(lake["mean_depth_m"][0]).rstrip('0').rstrip('.')) + """</div>
-    </div>
-    
-    <div class="legend-section">
-        <div class="legend-title"><span class="color">Profondità massima</span></div>
-        <div class="legend-item">""" + add_m(str(lake["max_depth_m"][0]).rstrip('0').rstrip('.')) + """</div>
-    </div>
-    
-    <div class="legend-section">
-        <div class="legend-title"><span class="color">Superficie</span></div>
-        <div class="legend-item">""" + str(lake["surface_area_km2"][0]).rstrip('0').rstrip('.') + """ km²</div>
-    </div>
-    
-    <div class="legend-section">
-        <div class="legend-title"><span class="color">Volume</span></div>
-        <div class="legend-item">""" + add_km3(str(lake["volume_km3"][0]).rstrip('0').rstrip('.')) + """</div>
-    </div>
-    
-    <div class="legend-section">
-        <div class="legend-title"><span class="color">Profondità di campionamento</span></div>
-        <div class="legend-item">""" + str(lake["sampling_depth"][0]) + """ m</div>
-    </div>
-    
-    <div class="legend-section">
-        <div class="legend-title"><span class="color">Orario di campionamento</span></div>
-        <div class="legend-item">""" + lake["sampling_time_of_day"][0] + """</div>
-    </div>
-
-    <div class="legend-section">
-        <div class="legend-title"><span class="color">Periodo di campionamento</span></div>
-        <div class="legend-item">""" + lake["time_period"][0] + """</div>
-    </div>
-    """,
-    unsafe_allow_html=True,
-)
-
-# Visualizzazione del grafico di dispersione della temperatura dell'acqua
-col2.markdown("""
-    ### Temperatura dell'acqua
-    Temperature medie delle acque superficiali del lago rilevate giornalmente durante
-    il trimestre estivo con il metodo *""" + lake["source"][0].capitalize() + """* in gradi centigradi
-""")
-
-col2.altair_chart(get_lineplot_lake(data, lakeID), use_container_width=True)
-
-# Visualizzazione del grafico delle temperature dell'aria
-col2.markdown("""
-    ### Temperatura dell'aria
-    Temperature medie dell'aria rilevate giornalmente durante il trimestre estivo, il trimestre invernale e durante l'anno
-    in gradi centigradi  
-    source: Climatic Research Unit (CRU)
-""")
-
-col2.altair_chart(get_lineplot_air_temp(data, lakeID), use_container_width = True)
-
-# Visualizzazione dei barplot della copertura nuvolosa in inverno, annuale ed in estate
-col2.markdown("""
-    ### Copertura nuvolosa
-    Medie delle percentuali di copertura nuvolosa rilevate giornalmente durante il trimestre estivo, il trimestre invernale e durante l'anno  
-    source: Advanced Very High Resolution Radiometer Pathfinder Atmosphere Extended dataset (PATMOS)
-""")
-
-clouds = get_barplot_cloud(data, lakeID)
-for cloud in clouds:
-    col2.altair_chart(cloud, use_container_width = True)
-
-# Visualizzazione del grafico della radiazione totale in inverno, annuale ed in estate
-col2.markdown("""
-    ### Radiazione solare
-    Quantità totale di radiazione solare in entrata rilevata durante il trimestre estivo, il trimestre invernale e durante l'anno
-    misurata in watt per metro quadrato  
-    source: Surface Radiation Budget (SRB)
-""")
-
-col2.altair_chart(get_lineplot_radiation(data, lakeID), use_container_width = True)
\ No newline at end of file
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Nome del lago</span></div>
+            <div class="legend-name">""" + lake["Lake_name"][0] + """</div>
+        </div>
+
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Tipo di lago</span></div>
+            <div class="legend-item">""" + lake["lake_or_reservoir"][0] + """</div>
+        </div>
+
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Stato</span></div>
+            <div class="legend-item">""" + lake["location"][0] + """</div>
+        </div>
+    
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Regione</span></div>
+            <div class="legend-item">""" + lake["region"][0] + """</div>
+        </div>
+    
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Metodo di campionamento</span></div>
+            <div class="legend-item">""" + lake["source"][0].capitalize() + """</div>
+        </div>
+    
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Elevazione dal livello del mare</span></div>
+            <div class="legend-item">""" + format_measure(lake["elevation_m"][0], "m") + """</div>
+        </div>
+    
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Profondità media</span></div>
+            <div class="legend-item">""" + format_measure(lake["mean_depth_m"][0], "m") + """</div>
+        </div>
+    
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Profondità massima</span></div>
+            <div class="legend-item">""" + format_measure(lake["max_depth_m"][0], "m") + """</div>
+        </div>
+    
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Superficie</span></div>
+            <div class="legend-item">""" + format_measure(lake["surface_area_km2"][0], "km²") + """</div>
+        </div>
+    
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Volume</span></div>
+            <div class="legend-item">""" + format_measure(lake["volume_km3"][0], "km³") + """</div>
+        </div>
+    
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Profondità di campionamento</span></div>
+            <div class="legend-item">""" + format_measure(lake["sampling_depth"][0], "m") + """</div>
+        </div>
+    
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Orario di campionamento</span></div>
+            <div class="legend-item">""" + (lake["sampling_time_of_day"][0] or "Dato non presente") + """</div>
+        </div>
+
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Periodo di campionamento</span></div>
+            <div class="legend-item">""" + lake["time_period"][0] + """</div>
+        </div>
+
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Riscaldamento dell'acqua</span></div>
+            <div class="legend-item">""" + format_trend(lake_trend) + """</div>
+        </div>
+
+        <div class="legend-section">
+            <div class="legend-title"><span class="color">Riscaldamento dell'aria in estate</span></div>
+            <div class="legend-item">""" + format_trend(air_trend) + """</div>
+        </div>
+        """,
+        unsafe_allow_html=True,
+    )
+
+    # Visualizzazione del grafico di dispersione della temperatura dell'acqua
+    col2.markdown("""
+        ### Temperatura dell'acqua
+        Temperature medie delle acque superficiali del lago rilevate giornalmente durante
+        il trimestre estivo con il metodo *""" + lake["source"][0].capitalize() + """* in gradi centigradi
+    """)
+
+    col2.vega_lite_chart(
+        cached_spec(lakeID, "lake", lambda: get_lineplot_lake(data, index, missing, lakeID).to_json(), lake_data),
+        use_container_width = True
+    )
+
+    # Visualizzazione del grafico delle temperature dell'aria
+    col2.markdown("""
+        ### Temperatura dell'aria
+        Temperature medie dell'aria rilevate giornalmente durante il trimestre estivo, il trimestre invernale e durante l'anno
+        in gradi centigradi  
+        source: Climatic Research Unit (CRU)
+    """)
+
+    col2.vega_lite_chart(
+        cached_spec(lakeID, "air_temp", lambda: get_lineplot_air_temp(data, index, lakeID).to_json(), lake_data),
+        use_container_width = True
+    )
+
+    # Visualizzazione dei barplot della copertura nuvolosa in inverno, annuale ed in estate
+    col2.markdown("""
+        ### Copertura nuvolosa
+        Medie delle percentuali di copertura nuvolosa rilevate giornalmente durante il trimestre estivo, il trimestre invernale e durante l'anno  
+        source: Advanced Very High Resolution Radiometer Pathfinder Atmosphere Extended dataset (PATMOS)
+    """)
+
+    clouds = cached_spec(
+        lakeID, "cloud",
+        lambda: "[" + ",".join(cloud.to_json() for cloud in get_barplot_cloud(data, index, missing, lakeID)) + "]",
+        lake_data
+    )
+    for cloud in clouds:
+        col2.vega_lite_chart(cloud, use_container_width = True)
+
+    # Visualizzazione del grafico della radiazione totale in inverno, annuale ed in estate
+    col2.markdown("""
+        ### Radiazione solare
+        Quantità totale di radiazione solare in entrata rilevata durante il trimestre estivo, il trimestre invernale e durante l'anno
+        misurata in watt per metro quadrato  
+        source: Surface Radiation Budget (SRB)
+    """)
+
+    col2.vega_lite_chart(
+        cached_spec(lakeID, "radiation", lambda: get_lineplot_radiation(data, index, lakeID).to_json(), lake_data),
+        use_container_width = True
+    )
+    
+    debug_flush("lake")
+
+# Funzione che costruisce il grafico riassuntivo per regione: la correlazione mediana
+# tra temperatura dell'acqua e ciascun fattore climatico
+@instrument
+def get_barplot_drivers(summary):
+    
+    return alt.Chart(
+        summary.with_columns(pl.col("driver").cast(pl.String).replace_strict(DRIVERS))
+    ).mark_bar().encode(
+        
+        alt.X("r:Q", title = "Correlazione mediana", scale = alt.Scale(domain = [-1, 1])),
+        alt.Y("region:N", title = None),
+        alt.YOffset("driver:N"),
+        alt.Color("driver:N", title = "Fattore climatico", legend = alt.Legend(orient = "bottom")),
+        tooltip = [
+            alt.Tooltip("region:N", title = "Regione"),
+            alt.Tooltip("driver:N", title = "Fattore"),
+            alt.Tooltip("lakes:Q", title = "Laghi"),
+            alt.Tooltip("r:Q", title = "Correlazione mediana", format = ".2f"),
+            alt.Tooltip("positive:Q", title = "Laghi con correlazione positiva", format = ".0%"),
+            alt.Tooltip("beta:Q", title = "Coefficiente standardizzato mediano", format = ".2f")
+        ]
+        
+    ).properties(
+        height = 450
+    )
+
+# Funzione che mostra il riepilogo per regione e la classifica dei laghi per fattore climatico.
+# È un fragment: i risultati sono precalcolati e il cambio di fattore o di ordinamento
+# riesegue solo questa sezione
+@st.fragment
+def drivers_section(lakeinformation, drivers):
+    
+    st.divider()
+    
+    col1, col2, col3 = st.columns([0.15, 0.7, 0.15])
+    
+    col2.markdown("""
+    ## Fattori climatici
+    Relazione tra la temperatura estiva dell'acqua e la temperatura dell'aria, la copertura nuvolosa e la radiazione solare
+    estive di ciascun lago. La correlazione è calcolata sugli anni in cui sono presenti entrambe le serie, i coefficienti
+    standardizzati con una regressione multipla su tutti i fattori: indicano di quante deviazioni standard varia
+    la temperatura dell'acqua per una deviazione standard del fattore.
+    """)
+    
+    col2.altair_chart(get_barplot_drivers(region_drivers(drivers, lakeinformation)), use_container_width = True)
+    
+    # Classifica dei laghi per sensibilità ad un fattore
+    col2.markdown("### Classifica dei laghi")
+    driver = col2.selectbox("Fattore climatico:", list(DRIVERS), format_func = DRIVERS.get)
+    order = col2.radio("Ordina per:", ["Coefficiente standardizzato", "Correlazione"], horizontal = True)
+    
+    ranking = drivers.filter(
+        pl.col("driver") == driver
+    ).join(
+        lakeinformation.select("siteID", "Lake_name", "region"), on = "siteID"
+    ).sort(
+        "beta" if order == "Coefficiente standardizzato" else "r",
+        descending = True, nulls_last = True
+    ).select(
+        pl.col("Lake_name").alias("Lago"),
+        pl.col("region").alias("Regione"),
+        pl.col("beta").round(2).alias("Coefficiente standardizzato"),
+        pl.col("r").round(2).alias("Correlazione"),
+        pl.col("r2").round(2).alias("R² del modello"),
+        pl.col("n_years").alias("Anni")
+    )
+    
+    col2.dataframe(ranking, hide_index = True, use_container_width = True)
+    
+    debug_flush("drivers")
+
+# Funzione che costruisce l'app
+def main():
+    
+    # Configurazione della pagina web
+    st.set_page_config(
+        layout = "wide",
+        initial_sidebar_state = "collapsed",
+        page_title = "Lake temperatures"
+    )
+    
+    # Caricamento dei dataset dalla cache condivisa, con le versioni usate dalla cache dei grafici
+    (data, lakeinformation, index, missing, heatmaps, trends, drivers), version, lake_versions = get_data()
+    
+    # Inserimento del titolo e dell'introduzione
+    start_page()
+    
+    # Inserimento del contesto e sintesi
+    background(heatmaps)
+    
+    # Inserimento dei metodi di campionamento della temperature dell'acqua
+    methods(lakeinformation)
+    
+    # Inserimento della sezione del lago
+    lake_section(data, lakeinformation, index, missing, trends, version, lake_versions)
+    
+    # Inserimento del confronto tra più laghi
+    comparison_section(data, lakeinformation, index)
+    
+    # Inserimento del confronto tra laghi e fattori climatici
+    drivers_section(lakeinformation, drivers)
+    
+    # Pannello con le misurazioni dei rerun, solo se la strumentazione è attiva
+    if DEBUG:
+        debug_flush("app")
+        with st.sidebar:
+            debug_panel()
+
+# L'app viene costruita solo quando il file viene eseguito (streamlit run app.py)
+# e non quando viene importato, ad esempio dai benchmark
+if __name__ == "__main__":
+    main()
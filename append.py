@@ -0,0 +1,33 @@
+import argparse
+import time
+
+import polars as pl
+
+import app
+from ingest import print_rules
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description = "Aggiunge ai valori le righe di un csv con lo stesso formato di values.csv (ad esempio una nuova stagione)"
+    )
+    parser.add_argument("rows", help = "csv con le righe da aggiungere")
+    parser.add_argument("--values", default = "values.csv", help = "csv con i valori")
+    parser.add_argument("--lakeinformation", default = "lakeinformation.csv", help = "csv con le informazioni dei laghi")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    path, rows, report = app.append_values(args.rows, args.values, args.lakeinformation)
+
+    # Righe scartate o corrette dalle regole di validazione
+    print_rules([rule for rule in report if rule["rows"]])
+
+    added = pl.read_ipc(path, columns = ["siteID", "year"])
+    print(
+        f"{rows} righe di {added.get_column('siteID').n_unique()} laghi "
+        f"({added.get_column('year').min()}-{added.get_column('year').max()}) aggiunte in {path} "
+        f"in {time.perf_counter() - start:.2f} s"
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import polars as pl
+
+import app
+
+# Laghi su cui vengono misurati i grafici del singolo lago
+SAMPLE_LAKES = 5
+
+# Laghi della nuova stagione aggiunta con update_data
+APPEND_LAKES = 300
+
+# Intervallo (in secondi) con cui viene campionata la memoria del processo
+SAMPLE_INTERVAL = 0.005
+
+# Funzione che ritorna la memoria residente del processo in byte, se disponibile
+def rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+# Funzione che esegue fn e ritorna il risultato, il tempo impiegato ed il picco di memoria
+# residente oltre a quella presente all'avvio. La memoria viene campionata in un thread,
+# dato che polars alloca al di fuori dell'allocatore di python
+def measure(fn, *args):
+
+    start_rss = rss()
+    peak = [start_rss]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(SAMPLE_INTERVAL):
+            peak[0] = max(peak[0], rss())
+
+    sampler = threading.Thread(target = sample, daemon = True) if start_rss is not None else None
+    if sampler:
+        sampler.start()
+
+    start = time.perf_counter()
+    result = fn(*args)
+    seconds = time.perf_counter() - start
+
+    done.set()
+    if sampler:
+        sampler.join()
+        peak[0] = max(peak[0], rss())
+
+    return result, seconds, None if start_rss is None else peak[0] - start_rss
+
+# Funzione che ritorna la dimensione in byte dello spec JSON di un grafico
+def spec_size(chart):
+
+    if isinstance(chart, list):
+        return sum(spec_size(c) for c in chart)
+    if isinstance(chart, dict):
+        return len(json.dumps(chart))
+    if isinstance(chart, tuple):
+        # Immagine dell'heatmap con il dominio dei colori
+        return chart[0].nbytes
+
+    return len(chart.to_json())
+
+# Funzione che ritorna il numero di dataset duplicati negli spec Vega-Lite di un grafico
+def spec_duplicates(chart):
+
+    if isinstance(chart, list):
+        return sum(spec_duplicates(c) for c in chart)
+    if isinstance(chart, (dict, tuple)):
+        return 0
+
+    return len(app.duplicate_datasets(chart.to_dict()))
+
+# Funzione che costruisce l'heatmap completo di una regione come in get_rect:
+# un grafico entro il budget di celle, altrimenti l'immagine
+def render_heatmap(heatmap):
+    
+    columns, names, matrix = app.heatmap_rows(heatmap, heatmap["orders"]["Nome"])
+    
+    if matrix.size <= app.HEATMAP_CELL_BUDGET:
+        return app.get_heatmap(columns, names, heatmap["years"], matrix)
+    
+    return app.get_heatmap_image(matrix)
+
+# Funzione che scrive un values.csv ingrandito replicando i laghi (lakes volte)
+# e l'intervallo degli anni (years volte) del csv originale
+def scale_csv(source, target, lakes, years):
+
+    raw = pl.read_csv(source)
+
+    # I siteID delle copie non si sovrappongono a quelli originali
+    site_step = raw.get_column("siteID").max() + 1
+    year_start = raw.get_column("year").min()
+    year_span = raw.get_column("year").max() - year_start + 1
+
+    scaled = pl.concat([
+        raw.with_columns(
+            pl.col("siteID") + i * site_step,
+            pl.col("year") + j * year_span
+        )
+        for i in range(lakes)
+        for j in range(years)
+    ]).with_columns(
+        # recordID univoci: le copie del record duplicato seguono sempre l'originale
+        # e vengono scartate dalla regola dei duplicati della compilazione
+        (pl.int_range(pl.len()) + 1_000_000).alias("recordID")
+    )
+
+    scaled.write_csv(target)
+
+    return site_step, range(year_start, year_start + year_span * years)
+
+# Funzione che scrive un lakeinformation.csv con i laghi replicati con gli stessi siteID
+# usati da scale_csv, in modo che le misurazioni delle copie non vengano scartate
+def scale_lakeinformation(source, target, lakes, site_step):
+
+    raw = pl.read_csv(source, encoding = "utf8-lossy")
+
+    pl.concat([
+        raw.with_columns(
+            pl.col("siteID") + i * site_step,
+            pl.col("Lake_name") + (" " + str(i) if i else "")
+        )
+        for i in range(lakes)
+    ]).write_csv(target)
+
+# Funzione che ritorna una nuova stagione di dati per i primi lakes laghi: i valori
+# dell'ultimo anno di ciascun lago, spostati all'anno successivo
+def new_season(values, lakes):
+
+    sites = values.get_column("siteID").unique().sort().head(lakes)
+
+    return values.filter(
+        pl.col("siteID").is_in(sites)
+    ).filter(
+        pl.col("year") == pl.col("year").max().over("siteID")
+    ).with_columns(
+        pl.col("year") + 1
+    )
+
+# Funzione che misura load_data, le strutture costruite al caricamento ed i grafici
+# per un dataset e ritorna una riga di risultati per ciascuna funzione
+def run(name, values_source, lakeinformation_source, lakes, years_scale, years, repeat):
+
+    results = []
+
+    def record(function, seconds, peak, rows = None, spec = None, duplicates = None):
+        results.append({
+            "dataset": name,
+            "lakes_scale": lakes,
+            "years_scale": years_scale,
+            "function": function,
+            "seconds": seconds,
+            "peak_bytes": peak,
+            "rows": rows,
+            "spec_bytes": spec,
+            "duplicate_datasets": duplicates
+        })
+
+    # Caricamento dei dataset, compresa la compilazione dei csv
+    def load():
+        values, lakeinformation = app.load_data(values_source, lakeinformation_source)
+        return values.collect(), lakeinformation
+
+    (values, lakeinformation), seconds, peak = measure(load)
+    record("load_data", seconds, peak, values.height)
+
+    # Strutture costruite una sola volta al caricamento
+    index, seconds, peak = measure(app.build_index, values)
+    record("build_index", seconds, peak, len(index))
+
+    cube, seconds, peak = measure(app.build_cube, values)
+    record("build_cube", seconds, peak, cube["values"].size)
+
+    trends, seconds, peak = measure(app.build_trends, cube)
+    record("build_trends", seconds, peak, trends.height)
+    
+    drivers, seconds, peak = measure(app.build_drivers, cube)
+    record("build_drivers", seconds, peak, drivers.height)
+
+    gaps, seconds, peak = measure(app.missing_years, values, None, years)
+    record("missing_years", seconds, peak, gaps.height)
+    missing = {"rows": gaps, "index": app.build_index(gaps), "years": years}
+
+    heatmaps, seconds, peak = measure(app.build_heatmaps, values, lakeinformation)
+    record("build_heatmaps", seconds, peak, sum(h["matrix"].size for h in heatmaps.values()))
+
+    # Aggiunta di una nuova stagione per APPEND_LAKES laghi: vengono ricalcolate
+    # solo le strutture dei laghi coinvolti
+    data = values, lakeinformation, index, missing, heatmaps, trends, drivers
+    season = new_season(values, APPEND_LAKES)
+    _, seconds, peak = measure(app.update_data, data, season)
+    record("update_data", seconds, peak, season.height)
+
+    spatial, seconds, peak = measure(app.build_spatial_index, lakeinformation)
+    record("build_spatial_index", seconds, peak, len(spatial["sites"]))
+    
+    # Ricerche spaziali attorno ai laghi di lakeinformation: mediana di tutte le ricerche
+    points = lakeinformation.select("latitude", "longitude").head(100).rows()
+    for function, query in [("lakes_within", lambda lat, lon: app.lakes_within(spatial, lat, lon, 200)),
+                            ("nearest_lakes", lambda lat, lon: app.nearest_lakes(spatial, lat, lon, 10))]:
+        timings = [measure(query, lat, lon)[1] for lat, lon in points]
+        record(function, statistics.median(timings), None)
+    
+    base, seconds, peak = measure(app.get_map_base, lakeinformation, trends)
+    record("get_map_base", seconds, peak, lakeinformation.height, spec_size(base))
+
+    # Grafici: per ciascuno viene riportata la mediana delle ripetizioni
+    lake_ids = lakeinformation.join(
+        values.select("siteID").unique(), on = "siteID", how = "semi"
+    ).get_column("siteID").head(SAMPLE_LAKES).to_list()
+
+    charts = {
+        "get_heatmap": [lambda region = region: render_heatmap(heatmaps[region]) for region in sorted(heatmaps)],
+        "get_map_method": [lambda: app.get_map_method(app.load_world(), lakeinformation)],
+        "get_map_interactive": [lambda lakeID = lakeID: app.get_map_interactive(lakeinformation, lakeID, name, trends) for lakeID in lake_ids],
+        "get_lineplot_lake": [lambda lakeID = lakeID: app.get_lineplot_lake(values, index, missing, lakeID) for lakeID in lake_ids],
+        "get_lineplot_air_temp": [lambda lakeID = lakeID: app.get_lineplot_air_temp(values, index, lakeID) for lakeID in lake_ids],
+        "get_barplot_cloud": [lambda lakeID = lakeID: app.get_barplot_cloud(values, index, missing, lakeID) for lakeID in lake_ids],
+        "get_lineplot_radiation": [lambda lakeID = lakeID: app.get_lineplot_radiation(values, index, lakeID) for lakeID in lake_ids],
+        "get_lineplot_comparison": [lambda: app.get_lineplot_comparison(values, index, lakeinformation, lake_ids)]
+    }
+
+    for function, calls in charts.items():
+
+        timings, peaks, specs = [], [], []
+
+        # Dataset duplicati negli spec dei grafici (deve essere 0)
+        duplicates = sum(spec_duplicates(call()) for call in calls)
+
+        for call in calls:
+            for _ in range(repeat):
+                # Il tempo comprende la serializzazione, che è parte del costo di ogni rerun
+                spec, seconds, peak = measure(lambda: spec_size(call()))
+                timings.append(seconds)
+                peaks.append(peak)
+                specs.append(spec)
+
+        record(
+            function,
+            statistics.median(timings),
+            None if None in peaks else max(peaks),
+            spec = max(specs),
+            duplicates = duplicates
+        )
+
+    return results
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Benchmark di load_data e dei grafici dell'app")
+    parser.add_argument("--values", default = "values.csv", help = "csv con i valori reali")
+    parser.add_argument("--lakeinformation", default = "lakeinformation.csv", help = "csv con le informazioni dei laghi")
+    parser.add_argument("--lake-scales", type = int, nargs = "*", default = [10, 100, 1000],
+                        help = "fattori di moltiplicazione del numero di laghi")
+    parser.add_argument("--year-scales", type = int, nargs = "*", default = [10, 100, 1000],
+                        help = "fattori di moltiplicazione dell'intervallo degli anni")
+    parser.add_argument("--repeat", type = int, default = 3, help = "ripetizioni di ciascun grafico")
+    parser.add_argument("--output", default = "benchmark.json", help = "file JSON dei risultati")
+    args = parser.parse_args()
+
+    # Le funzioni con st.cache_resource vengono eseguite senza il server di streamlit
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+    raw = pl.read_csv(args.values, columns = ["siteID", "year"])
+    years = range(raw.get_column("year").min(), raw.get_column("year").max() + 1)
+
+    results = run("real", args.values, args.lakeinformation, 1, 1, years, args.repeat)
+
+    # Dataset sintetici ingranditi lungo i laghi o lungo gli anni
+    scales = [(lakes, 1) for lakes in args.lake_scales] + [(1, years) for years in args.year_scales]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for lakes, years in scales:
+
+            name = f"lakes_x{lakes}_years_x{years}"
+            source = os.path.join(tmp, name + ".csv")
+            lakeinformation_source = os.path.join(tmp, name + "_lakeinformation.csv")
+            print(f"{name}: generazione del dataset", flush = True)
+            site_step, scaled_years = scale_csv(args.values, source, lakes, years)
+            scale_lakeinformation(args.lakeinformation, lakeinformation_source, lakes, site_step)
+
+            print(f"{name}: misurazione", flush = True)
+            results += run(name, source, lakeinformation_source, lakes, years, scaled_years, args.repeat)
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "polars": pl.__version__,
+            "results": results
+        }, f, indent = 2)
+
+    for row in results:
+        print(f"{row['dataset']:28} {row['function']:24} {row['seconds'] * 1000:10.2f} ms  spec {row['spec_bytes'] or '-'}"
+              f"  duplicati {'-' if row['duplicate_datasets'] is None else row['duplicate_datasets']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+import argparse
+import concurrent.futures
+import hashlib
+import html
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+
+import polars as pl
+import vl_convert as vlc
+from plotly import offline
+
+import app
+
+# Variabili usate dai grafici di ciascun lago: se i loro valori non cambiano
+# i file del lago non vengono rigenerati
+VARIABLES = [
+    "Lake_Temp_Summer_InSitu",
+    "Lake_Temp_Summer_Satellite",
+    "Air_Temp_Mean_Annual_CRU",
+    "Air_Temp_Mean_Summer_CRU",
+    "Air_Temp_Mean_Winter_CRU",
+    "Cloud_Cover_Annual",
+    "Cloud_Cover_Summer",
+    "Cloud_Cover_Winter",
+    "Radiation_Total_Annual",
+    "Radiation_Total_Summer",
+    "Radiation_Total_Winter"
+]
+
+# Nomi dei file dei grafici della copertura nuvolosa, nell'ordine di get_barplot_cloud
+CLOUD_FILES = ["cloud_winter", "cloud_annual", "cloud_summer"]
+
+# File con le impronte dei dati dell'ultima esportazione di ciascun lago
+MANIFEST = "manifest.json"
+
+# Dati caricati una sola volta da ciascun processo del pool
+worker = {}
+
+# Funzione che carica i dati nel processo del pool
+def init_worker(values_source, lakeinformation_source):
+
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+    values, lakeinformation = app.load_data(values_source, lakeinformation_source)
+    values = values.collect()
+    years = app.data_years(values)
+    gaps = app.missing_years(values, None, years)
+
+    worker.update({
+        "values": values,
+        "lakeinformation": lakeinformation,
+        "index": app.build_index(values),
+        "missing": {"rows": gaps, "index": app.build_index(gaps), "years": years},
+        "trends": app.build_trends(app.build_cube(values))
+    })
+
+# Funzione che ritorna l'impronta dei dati della mappa: la mappa di ogni lago mostra posizione,
+# nome e trend di tutti i laghi, quindi cambia se cambiano le informazioni o i trend di un lago qualsiasi
+def map_hash(lakeinformation, trends):
+
+    digest = hashlib.sha256(lakeinformation.write_csv().encode())
+    digest.update(trends.write_csv().encode())
+
+    return digest.hexdigest()
+
+# Funzione che ritorna l'impronta dei dati di un lago: le sue righe dei valori e delle
+# informazioni, insieme all'intervallo degli anni del dataset (che determina gli anni mancanti
+# e l'asse dei grafici), al codice dell'app, ai formati richiesti ed ai dati della mappa
+def lake_hash(values, index, lakeinformation, lakeID, years, code, formats, map_digest = None):
+
+    digest = hashlib.sha256(code)
+    digest.update(f"{years.start} {years.stop}".encode())
+    digest.update(" ".join(formats).encode())
+    if map_digest is not None:
+        digest.update(map_digest.encode())
+    digest.update(app.lake_rows(values, index, lakeID, VARIABLES).select("variable", "year", "value").write_csv().encode())
+    digest.update(lakeinformation.filter(pl.col("siteID") == lakeID).write_csv().encode())
+
+    return digest.hexdigest()
+
+# Funzione che scrive un grafico Altair nei formati richiesti e ritorna i byte scritti
+def write_chart(chart, path, formats):
+
+    written = 0
+    spec = chart.to_json()
+
+    for extension in formats:
+
+        if extension == "svg":
+            content = vlc.vegalite_to_svg(spec).encode()
+        elif extension == "png":
+            content = vlc.vegalite_to_png(spec, scale = 2)
+        else:
+            continue
+
+        with open(path + "." + extension, "wb") as f:
+            written += f.write(content)
+
+    return written
+
+# Funzione che rimuove dalla cartella di un lago i file dei formati non più richiesti
+def remove_stale(folder, charts, formats):
+
+    stale = [f"{chart}.{extension}" for chart in charts for extension in ("svg", "png") if extension not in formats]
+    if "html" not in formats:
+        stale += ["map.html", "index.html"]
+
+    for name in stale:
+        if os.path.exists(os.path.join(folder, name)):
+            os.remove(os.path.join(folder, name))
+
+# Funzione che rimuove le cartelle e le voci del manifest dei laghi non più presenti
+# in lakeinformation e ritorna il numero di laghi rimossi
+def remove_lakes(output, manifest, known):
+
+    removed = {site for site in manifest if site not in known}
+    removed |= {
+        name for name in os.listdir(output)
+        if name.isdigit() and name not in known and os.path.isdir(os.path.join(output, name))
+    }
+
+    for site in removed:
+        manifest.pop(site, None)
+        if os.path.isdir(os.path.join(output, site)):
+            shutil.rmtree(os.path.join(output, site))
+
+    return len(removed)
+
+# Funzione che esporta i grafici di un lago nella sua cartella e ritorna il siteID,
+# il numero di file ed i byte scritti
+def export_lake(lakeID, output, formats):
+
+    values, index, missing = worker["values"], worker["index"], worker["missing"]
+    lakeinformation = worker["lakeinformation"]
+
+    folder = os.path.join(output, str(lakeID))
+    os.makedirs(folder, exist_ok = True)
+
+    charts = {
+        "lake": app.get_lineplot_lake(values, index, missing, lakeID),
+        "air_temp": app.get_lineplot_air_temp(values, index, lakeID),
+        "radiation": app.get_lineplot_radiation(values, index, lakeID)
+    }
+    charts.update(zip(CLOUD_FILES, app.get_barplot_cloud(values, index, missing, lakeID)))
+
+    written = sum(write_chart(chart, os.path.join(folder, name), formats) for name, chart in charts.items())
+    files = len(charts) * len([extension for extension in formats if extension != "html"])
+
+    if "html" in formats:
+
+        # Mappa interattiva: plotly.js è salvato una sola volta nella cartella di esportazione.
+        # Le tessere della mappa vengono scaricate solo alla visualizzazione nel browser
+        figure = app.get_map_interactive(lakeinformation, lakeID, "export", worker["trends"])
+        offline.plot(
+            figure, filename = os.path.join(folder, "map.html"), auto_open = False,
+            include_plotlyjs = "../plotly.min.js"
+        )
+
+        written += write_page(folder, lakeinformation.filter(pl.col("siteID") == lakeID), charts, formats)
+        files += 2
+
+    remove_stale(folder, charts, formats)
+
+    return lakeID, files, written
+
+# Funzione che scrive la pagina statica di un lago con i grafici esportati
+def write_page(folder, lake, charts, formats):
+
+    image = "svg" if "svg" in formats else "png" if "png" in formats else None
+    name = html.escape(lake["Lake_name"][0])
+
+    figures = "".join(f'<img src="{chart}.{image}" alt="{chart}">\n' for chart in charts) if image else ""
+
+    page = f"""<!DOCTYPE html>
+<html lang="it">
+<head><meta charset="utf-8"><title>{name}</title></head>
+<body>
+<h1>{name}</h1>
+<p>{html.escape(lake["location"][0])} · {html.escape(str(lake["region"][0]))} · {html.escape(str(lake["source"][0]))}</p>
+<iframe src="map.html" width="100%" height="320" style="border: none"></iframe>
+{figures}<p><a href="../index.html">Tutti i laghi</a></p>
+</body>
+</html>
+"""
+
+    with open(os.path.join(folder, "index.html"), "w", encoding = "utf8") as f:
+        return f.write(page)
+
+# Funzione che scrive l'indice di tutti i laghi esportati
+def write_index(output, lakeinformation):
+
+    links = "".join(
+        f'<li><a href="{site}/index.html">{html.escape(name)}</a></li>\n'
+        for site, name in lakeinformation.sort("Lake_name").select("siteID", "Lake_name").iter_rows()
+    )
+
+    with open(os.path.join(output, "index.html"), "w", encoding = "utf8") as f:
+        f.write(f'<!DOCTYPE html>\n<html lang="it">\n<head><meta charset="utf-8"><title>Laghi</title></head>\n'
+                f'<body>\n<h1>Laghi</h1>\n<ul>\n{links}</ul>\n</body>\n</html>\n')
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Esporta i grafici di tutti i laghi in file statici")
+    parser.add_argument("--values", default = "values.csv", help = "csv con i valori")
+    parser.add_argument("--lakeinformation", default = "lakeinformation.csv", help = "csv con le informazioni dei laghi")
+    parser.add_argument("--output", default = "export", help = "cartella di esportazione")
+    parser.add_argument("--formats", nargs = "+", choices = ["svg", "png", "html"], default = ["svg", "html"],
+                        help = "formati dei file esportati")
+    parser.add_argument("--workers", type = int, default = os.cpu_count(), help = "processi del pool")
+    parser.add_argument("--lakes", type = int, nargs = "*", help = "siteID dei laghi da esportare (di default tutti)")
+    parser.add_argument("--force", action = "store_true", help = "esporta anche i laghi non modificati")
+    args = parser.parse_args()
+
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    start = time.perf_counter()
+
+    values, lakeinformation = app.load_data(args.values, args.lakeinformation)
+    values = values.collect()
+    index = app.build_index(values)
+
+    lake_ids = lakeinformation.get_column("siteID").to_list()
+    if args.lakes:
+        selected = set(args.lakes)
+        lake_ids = [lakeID for lakeID in lake_ids if lakeID in selected]
+
+    # Impronte dei dati: vengono esportati solo i laghi con dati o codice modificati
+    with open(app.__file__, "rb") as f:
+        code = f.read()
+
+    os.makedirs(args.output, exist_ok = True)
+    manifest_path = os.path.join(args.output, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    # I laghi usciti dal dataset vengono rimossi anche se si esporta solo una parte dei laghi
+    removed = remove_lakes(args.output, manifest, {str(lakeID) for lakeID in lakeinformation.get_column("siteID")})
+    if removed:
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent = 2)
+        print(f"{removed} laghi non più presenti rimossi", flush = True)
+
+    # Con l'html ogni lago ha la mappa di tutti i laghi: la sua impronta entra in quella di ogni lago
+    map_digest = map_hash(lakeinformation, app.build_trends(app.build_cube(values))) if "html" in args.formats else None
+
+    years = app.data_years(values)
+    hashes = {
+        str(lakeID): lake_hash(values, index, lakeinformation, lakeID, years, code, sorted(args.formats), map_digest)
+        for lakeID in lake_ids
+    }
+    pending = [lakeID for lakeID in lake_ids if args.force or manifest.get(str(lakeID)) != hashes[str(lakeID)]]
+
+    print(f"{len(pending)} laghi da esportare, {len(lake_ids) - len(pending)} non modificati", flush = True)
+
+    if "html" in args.formats:
+        # plotly.js incluso nel pacchetto plotly, senza download
+        with open(os.path.join(args.output, "plotly.min.js"), "w", encoding = "utf8") as f:
+            f.write(offline.get_plotlyjs())
+    else:
+        # Senza html l'indice ed il plotly.js di un'esportazione precedente non servono più
+        for name in ("index.html", "plotly.min.js"):
+            if os.path.exists(os.path.join(args.output, name)):
+                os.remove(os.path.join(args.output, name))
+
+    files = written = 0
+    export_start = time.perf_counter()
+
+    # I processi vengono avviati con spawn: un fork dopo l'uso del pool di thread
+    # di polars può bloccare i processi figli
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers = max(1, args.workers),
+        mp_context = multiprocessing.get_context("spawn"),
+        initializer = init_worker,
+        initargs = (args.values, args.lakeinformation)
+    ) as pool:
+
+        futures = [pool.submit(export_lake, lakeID, args.output, args.formats) for lakeID in pending]
+
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+
+            lakeID, lake_files, lake_bytes = future.result()
+            files += lake_files
+            written += lake_bytes
+
+            # Il manifest viene salvato periodicamente, in modo che un'interruzione
+            # non costringa a ripetere i laghi già esportati
+            manifest[str(lakeID)] = hashes[str(lakeID)]
+            if done % 50 == 0 or done == len(futures):
+                with open(manifest_path, "w") as f:
+                    json.dump(manifest, f, indent = 2)
+                print(f"{done}/{len(futures)} laghi esportati", flush = True)
+
+    if "html" in args.formats:
+        write_index(args.output, lakeinformation.filter(pl.col("siteID").is_in(lake_ids)))
+
+    seconds = time.perf_counter() - export_start
+    print(
+        f"{len(pending)} laghi, {files} file, {written / 1e6:.1f} MB in {seconds:.1f} s "
+        f"({len(pending) / seconds if seconds else 0:.1f} laghi/s, {files / seconds if seconds else 0:.1f} file/s); "
+        f"totale {time.perf_counter() - start:.1f} s"
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import argparse
+import os
+
+import numpy as np
+import polars as pl
+
+import app
+
+# Variabili generate di default: le temperature del lago (una per lago, in base al metodo
+# di campionamento) ed i fattori climatici
+VARIABLES = [
+    "Lake_Temp_Summer_InSitu",
+    "Lake_Temp_Summer_Satellite",
+    "Air_Temp_Mean_Annual_CRU",
+    "Air_Temp_Mean_Summer_CRU",
+    "Air_Temp_Mean_Winter_CRU",
+    "Air_Temp_Mean_Annual_NCEP",
+    "Air_Temp_Mean_Summer_NCEP",
+    "Air_Temp_Mean_Winter_NCEP",
+    "Cloud_Cover_Annual",
+    "Cloud_Cover_Summer",
+    "Cloud_Cover_Winter",
+    "Radiation_Total_Annual",
+    "Radiation_Total_Summer",
+    "Radiation_Total_Winter",
+    "Radiation_Shortwave_Annual",
+    "Radiation_Shortwave_Summer",
+    "Radiation_Shortwave_Winter",
+    "Radiation_Longwave_Annual",
+    "Radiation_Longwave_Summer",
+    "Radiation_Longwave_Winter"
+]
+
+# Per ciascuna regione: intervallo di latitudine, intervallo di longitudine e stati
+REGIONS = {
+    "Africa": ((-30, 15), (-10, 45), ["Ethiopia", "Kenya", "Uganda", "Tanzania", "Malawi"]),
+    "Asia": ((10, 60), (70, 140), ["China", "Russia", "Mongolia", "Kazakhstan", "Japan"]),
+    "Europe": ((40, 68), (-5, 35), ["Sweden", "Finland", "Germany", "Italy", "Austria"]),
+    "Middle East": ((28, 42), (35, 55), ["Turkey", "Iran", "Israel", "Iraq"]),
+    "Northeastern North America": ((40, 55), (-95, -65), ["United States", "Canada"]),
+    "Oceania": ((-45, -15), (115, 178), ["Australia", "New Zealand"]),
+    "South America": ((-45, 5), (-75, -40), ["Brazil", "Argentina", "Chile", "Bolivia"]),
+    "Southeastern North America": ((25, 38), (-95, -75), ["United States"]),
+    "Western North America": ((32, 60), (-125, -105), ["United States", "Canada"])
+}
+
+# Record duplicato presente nel dataset originale e scartato dalla regola dei duplicati della compilazione
+DUPLICATE_RECORD = 228540
+
+# Funzione che ritorna i siteID dei laghi generati, saltando quelli scartati dalla compilazione
+def site_ids(lakes):
+
+    ids = []
+    site = 1
+
+    while len(ids) < lakes:
+        if site not in app.DUPLICATE_SITES:
+            ids.append(site)
+        site += 1
+
+    return np.array(ids)
+
+# Funzione che genera le informazioni dei laghi con le stesse colonne di lakeinformation.csv
+def generate_lakeinformation(rng, lakes, region_weights):
+
+    regions = list(REGIONS)
+    weights = np.array([region_weights.get(region, 0) for region in regions], dtype = float)
+    region = rng.choice(len(regions), size = lakes, p = weights / weights.sum())
+
+    lat_range = np.array([REGIONS[regions[r]][0] for r in region])
+    lon_range = np.array([REGIONS[regions[r]][1] for r in region])
+    latitude = rng.uniform(lat_range[:, 0], lat_range[:, 1])
+    longitude = rng.uniform(lon_range[:, 0], lon_range[:, 1])
+
+    satellite = rng.random(lakes) < 0.53
+    mean_depth = rng.lognormal(2.5, 1, lakes)
+    max_depth = mean_depth * rng.uniform(1.5, 3, lakes)
+    surface = rng.lognormal(4, 1.8, lakes)
+
+    # Alcune profondità e volumi non sono noti, come nel dataset originale
+    unknown = rng.random(lakes) < 0.1
+
+    ids = site_ids(lakes)
+
+    return pl.DataFrame({
+        "siteID": ids,
+        "Lake_name": [f"Synthetic.{i}" for i in ids],
+        "Other_names": [None] * lakes,
+        "lake_or_reservoir": np.where(rng.random(lakes) < 0.8, "Lake", "Reservoir"),
+        "location": [rng.choice(REGIONS[regions[r]][2]) for r in region],
+        "region": [regions[r] for r in region],
+        "latitude": latitude.round(2),
+        "longitude": longitude.round(2),
+        "geospatial_accuracy_km": np.where(satellite, 2.0, 0.5),
+        "elevation_m": rng.uniform(0, 2000, lakes).round(2),
+        "mean_depth_m": mean_depth.round(2),
+        "max_depth_m": max_depth.round(2),
+        "surface_area_km2": surface.round(2),
+        "volume_km3": (surface * mean_depth / 1000).round(2),
+        "source": np.where(satellite, "satellite", "in situ"),
+        "sampling_depth": np.where(satellite, "skin-derived bulk temperature", "1"),
+        "sampling_time_of_day": np.where(satellite, "22:00-5:00", "continuous"),
+        # Il trimestre estivo dipende dall'emisfero
+        "time_period": np.where(latitude >= 0, "JAS", "JFM"),
+        "contributor": ["Synthetic data"] * lakes
+    }).with_columns(
+        pl.when(pl.Series(unknown)).then(None).otherwise(pl.col(column)).alias(column)
+        for column in ["mean_depth_m", "max_depth_m", "volume_km3"]
+    )
+
+# Funzione che genera i valori nel formato lungo di values.csv (recordID, variable, year, siteID, value)
+def generate_values(rng, lakeinformation, variables, years, missing_rate):
+
+    lakes = lakeinformation.height
+    latitude = np.abs(lakeinformation.get_column("latitude").to_numpy())
+    satellite = (lakeinformation.get_column("source") == "satellite").to_numpy()
+    year = np.array(years)
+
+    # Riscaldamento per anno di ciascun lago
+    trend = rng.normal(0.034, 0.02, lakes)[:, None] * (year - year[0])[None, :]
+
+    frames = []
+
+    for variable in variables:
+
+        # Ogni lago ha una sola temperatura del lago, in base al metodo di campionamento
+        if variable == "Lake_Temp_Summer_InSitu":
+            sites = ~satellite
+        elif variable == "Lake_Temp_Summer_Satellite":
+            sites = satellite
+        else:
+            sites = np.ones(lakes, dtype = bool)
+
+        shape = (lakes, len(year))
+        noise = rng.normal(0, 1, shape)
+
+        if variable.startswith("Lake_Temp") or variable.startswith("Air_Temp"):
+            base = 30 - 0.4 * latitude
+            if "Winter" in variable:
+                base = base - 15
+            elif "Annual" in variable:
+                base = base - 8
+            value = base[:, None] + trend + noise
+        elif variable.startswith("Cloud_Cover"):
+            value = np.clip(rng.uniform(0.3, 0.8, lakes)[:, None] + 0.05 * noise, 0, 1)
+        else:
+            value = (300 - 2.5 * latitude)[:, None] + 10 * noise
+            if "Winter" in variable:
+                value = value - 100
+
+        # Rimozione casuale delle osservazioni
+        present = sites[:, None] & (rng.random(shape) >= missing_rate)
+        site_index, year_index = np.nonzero(present)
+
+        frames.append(pl.DataFrame({
+            "variable": variable,
+            "year": year[year_index],
+            "siteID": lakeinformation.get_column("siteID").to_numpy()[site_index],
+            "value": value[present].round(3)
+        }))
+
+    values = pl.concat(frames)
+
+    # recordID progressivi senza il record duplicato, aggiunto in fondo come nel dataset originale
+    record = np.arange(1, values.height + 2)
+    record = record[record != DUPLICATE_RECORD][:values.height]
+
+    values = values.with_columns(
+        pl.Series("recordID", record)
+    ).select(
+        "recordID", "variable", "year", "siteID", "value"
+    )
+
+    duplicate = values.head(1).with_columns(pl.lit(DUPLICATE_RECORD, dtype = pl.Int64).alias("recordID"))
+
+    return pl.concat([values, duplicate])
+
+# Funzione che legge i pesi delle regioni nella forma "Europe=2,Asia=1"
+def parse_weights(text):
+
+    if not text:
+        return {region: 1 for region in REGIONS}
+
+    weights = {}
+    for item in text.split(","):
+        region, weight = item.rsplit("=", 1)
+        if region.strip() not in REGIONS:
+            raise SystemExit(f"Regione sconosciuta: {region.strip()}")
+        weights[region.strip()] = float(weight)
+
+    return weights
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Genera values.csv e lakeinformation.csv sintetici")
+    parser.add_argument("--lakes", type = int, default = 291, help = "numero di laghi")
+    parser.add_argument("--start-year", type = int, default = 1985, help = "primo anno")
+    parser.add_argument("--end-year", type = int, default = 2009, help = "ultimo anno (compreso)")
+    parser.add_argument("--variables", nargs = "*", default = VARIABLES, help = "variabili da generare")
+    parser.add_argument("--missing-rate", type = float, default = 0.1, help = "frazione di osservazioni mancanti")
+    parser.add_argument("--regions", default = "", help = 'pesi delle regioni, ad esempio "Europe=2,Asia=1"')
+    parser.add_argument("--seed", type = int, default = 0, help = "seme del generatore casuale")
+    parser.add_argument("--output-dir", default = "synthetic", help = "cartella in cui salvare i csv")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+
+    lakeinformation = generate_lakeinformation(rng, args.lakes, parse_weights(args.regions))
+    values = generate_values(
+        rng, lakeinformation, args.variables, range(args.start_year, args.end_year + 1), args.missing_rate
+    )
+
+    os.makedirs(args.output_dir, exist_ok = True)
+    lakeinformation.write_csv(os.path.join(args.output_dir, "lakeinformation.csv"))
+    values.write_csv(os.path.join(args.output_dir, "values.csv"))
+
+    print(f"{lakeinformation.height} laghi e {values.height} valori salvati in {args.output_dir}")
+
+if __name__ == "__main__":
+    main()
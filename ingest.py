@@ -0,0 +1,36 @@
+import argparse
+import time
+
+import app
+
+# Funzione che stampa il rapporto delle regole: una riga per regola con le righe coinvolte
+def print_rules(rules):
+
+    for rule in rules:
+        sites = ", ".join(str(site) for site in rule["sites"])
+        print(f"{rule['table']:16} {rule['rule']:28} {rule['action']:5} {rule['rows']:10}  {rule['description']}"
+              + (f" (siteID {sites})" if sites else ""))
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description = "Valida values.csv e lakeinformation.csv con le regole dell'app e scrive il dataset compilato "
+                      "(file Arrow mappati in memoria dall'app) con il rapporto di qualità"
+    )
+    parser.add_argument("--values", default = "values.csv", help = "csv con i valori")
+    parser.add_argument("--lakeinformation", default = "lakeinformation.csv", help = "csv con le informazioni dei laghi")
+    parser.add_argument("--output", help = "cartella del dataset compilato (di default accanto a --values)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    report = app.compile_dataset(args.values, args.lakeinformation, args.output)
+
+    print_rules(report["rules"])
+    for name, table in report["tables"].items():
+        nulls = ", ".join(f"{column} {count}" for column, count in table["nulls"].items())
+        print(f"{name}: {table['rows_in']} righe lette, {table['rows_out']} compilate" + (f"; valori nulli: {nulls}" if nulls else ""))
+
+    print(f"Dataset compilato in {args.output or app.dataset_folder(args.values)} in {time.perf_counter() - start:.2f} s")
+
+if __name__ == "__main__":
+    main()
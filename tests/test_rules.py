@@ -0,0 +1,36 @@
+import unittest
+
+import polars as pl
+
+import app
+
+# Test delle regole di validazione di values.csv
+class TestValueRules(unittest.TestCase):
+
+    # Funzione che applica le regole ad alcuni valori della copertura nuvolosa di un lago
+    def apply(self, values):
+        frame = pl.DataFrame({
+            "siteID": list(range(1, len(values) + 1)),
+            "variable": ["Cloud_Cover_Summer"] * len(values),
+            "year": [2000] * len(values),
+            "value": values
+        })
+        return app.apply_rules(frame, app.VALUE_RULES, "values", pl.Series(frame["siteID"]))
+
+    def test_cloud_fraction_just_above_one_is_dropped(self):
+        values, report = self.apply([1.084, 1.032, 1.5])
+        self.assertTrue(values.is_empty())
+        rules = {rule["rule"]: rule["rows"] for rule in report}
+        self.assertEqual(rules["copertura_percentuale"], 0)
+        self.assertEqual(rules["fuori_intervallo"], 3)
+
+    def test_cloud_percentage_is_converted(self):
+        values, report = self.apply([45.0, 100.0, 0.45])
+        self.assertEqual(values["value"].to_list(), [0.45, 1.0, 0.45])
+
+    def test_cloud_value_above_hundred_is_dropped(self):
+        values, report = self.apply([108.4])
+        self.assertTrue(values.is_empty())
+
+if __name__ == "__main__":
+    unittest.main()